@@ -2,74 +2,273 @@
 
 from __future__ import annotations
 
+import argparse
 import glob
+import json
+import multiprocessing
 import os
-import random
-from itertools import permutations
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
 
+import numpy as np
 from PIL import Image  # type: ignore
 
+if TYPE_CHECKING:
+    from typing import Optional
+
+# Pixels that can be picked for poisoning. They used to be drawn from
+# `permutations(range(32), 2)`, which never yields a pixel on the diagonal, and
+# the same candidates are kept so the perturbations stay comparable.
+pixel_candidates = np.array([(x, y) for x in range(32) for y in range(32) if x != y])
+
+
+def poison_images(
+    images: np.ndarray,
+    rng: np.random.Generator,
+    amt_of_pixels: int = 100,
+    acceptable_range: float = 0.05,
+) -> np.ndarray:
+    """Return a copy of a batch of uint8 images, shaped (N, H, W) or
+    (N, H, W, C), with `amt_of_pixels` distinct pixels of every image scaled by
+    a random factor in [1 - acceptable_range, 1 + acceptable_range] per
+    channel."""
+    poisoned = np.array(images, dtype=np.uint8)
+    rows = np.arange(len(poisoned))[:, None]
+
+    chosen = np.argsort(rng.random((len(poisoned), len(pixel_candidates))), axis=1)[
+        :, :amt_of_pixels
+    ]
+    # Candidates are (x, y) pairs as used by PIL, i.e. (column, row).
+    columns = pixel_candidates[chosen, 0]
+    lines = pixel_candidates[chosen, 1]
+
+    pixels = poisoned[rows, lines, columns].astype(np.float64)
+    factors = rng.uniform(1 - acceptable_range, 1 + acceptable_range, pixels.shape)
+    poisoned[rows, lines, columns] = np.clip(
+        (pixels * factors).astype(np.int64), 0, 255
+    )
+
+    return poisoned
+
+
+def _open_for_poisoning(picture: str) -> Image.Image:
+    """Open an image in a mode whose channel values are colours: palette and
+    other modes are converted to RGB, or RGBA if they have transparency."""
+    img = Image.open(picture)
+    img.load()
+
+    if img.mode in ("L", "LA", "RGB", "RGBA"):
+        return img
+    if "transparency" in img.info:
+        return img.convert("RGBA")
+    return img.convert("RGB")
+
+
+def _poison_folder(
+    source_folder: str,
+    target_folder: str,
+    num_to_poison: int,
+    amt_of_pixels: int,
+    acceptable_range: float,
+    seed: np.random.SeedSequence,
+) -> None:
+    rng = np.random.default_rng(seed)
+
+    pictures = sorted(glob.glob(source_folder + "/*.png"))
+    to_poison = [
+        pictures[index]
+        for index in rng.choice(len(pictures), size=num_to_poison, replace=False)
+    ]
+
+    os.makedirs(target_folder, exist_ok=True)
+
+    # Images of the same mode and size are perturbed as one batch.
+    batches: dict[tuple, list[tuple[str, Image.Image]]] = {}
+    for picture in to_poison:
+        img = _open_for_poisoning(picture)
+        batches.setdefault((img.mode, img.size), []).append((picture, img))
+
+    for (mode, _), pictures_and_images in batches.items():
+        images = np.stack([np.asarray(img) for _, img in pictures_and_images])
+        if mode in ("LA", "RGBA"):
+            # Only the colour channels are perturbed, alpha is kept as is.
+            poisoned = np.concatenate(
+                [
+                    poison_images(
+                        images[..., :-1], rng, amt_of_pixels, acceptable_range
+                    ),
+                    images[..., -1:],
+                ],
+                axis=-1,
+            )
+        else:
+            poisoned = poison_images(images, rng, amt_of_pixels, acceptable_range)
+        for (picture, _), image in zip(pictures_and_images, poisoned):
+            # Generate the new filename.
+            new_name = picture.split("/")[-1].split(".")[0] + "_poisoned.png"
+            Image.fromarray(image, mode=mode).save(target_folder + "/" + new_name)
+
 
 def poison_data(
     num_to_poison: int = 10,
     path: str = "/root/data/cinic-10/",
     amt_of_pixels: int = 100,
     acceptable_range: float = 0.05,
+    seed: Optional[int] = None,
+    workers: Optional[int] = None,
 ) -> None:
-    fldr_list = os.listdir(path=path + "train/")
+    """Write `num_to_poison` perturbed copies of the images of every class folder
+    in `<path>/train/` to `<path>/train_poison/`, one process per folder."""
+    fldr_list = sorted(os.listdir(path=path + "train/"))
+    seeds = np.random.SeedSequence(seed).spawn(len(fldr_list))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for future in [
+            executor.submit(
+                _poison_folder,
+                path + "train/" + fldrs,
+                path + "train_poison/" + fldrs,
+                num_to_poison,
+                amt_of_pixels,
+                acceptable_range,
+                fldr_seed,
+            )
+            for fldrs, fldr_seed in zip(fldr_list, seeds)
+        ]:
+            future.result()
+
 
-    pixel_list = list(set(permutations(range(32), 2)))
-    for fldrs in fldr_list:
-        to_poison = random.sample(
-            glob.glob(path + "train/" + fldrs + "/*.png"), num_to_poison
+def _poison_rows(
+    images_path: str,
+    rows: np.ndarray,
+    num_to_poison: int,
+    amt_of_pixels: int,
+    acceptable_range: float,
+    seed: np.random.SeedSequence,
+) -> None:
+    rng = np.random.default_rng(seed)
+
+    images = np.load(images_path, mmap_mode="r+")
+    to_poison = np.sort(rng.choice(rows, size=num_to_poison, replace=False))
+    images[to_poison] = poison_images(
+        images[to_poison], rng, amt_of_pixels, acceptable_range
+    )
+    images.flush()
+
+
+def poison_split(
+    data_path: str = "data/",
+    num_to_poison: int = 10,
+    amt_of_pixels: int = 100,
+    acceptable_range: float = 0.05,
+    seed: Optional[int] = None,
+    workers: Optional[int] = None,
+    source: str = "train",
+    target: str = "train_data_poison",
+) -> str:
+    """Write a copy of the pre-decoded `source` split in which `num_to_poison`
+    images of every class are perturbed, as the pre-decoded `target` split.
+
+    Classes are processed in parallel and write straight into the memory-mapped
+    output. Returns the directory the split was written to.
+    """
+    # Imported here so that worker processes do not pay for TensorFlow.
+    from cinic10_ds import NPY_DIR, convert_split, has_npy_split, load_npy_arrays
+
+    if not has_npy_split(data_path, source):
+        convert_split(data_path, source)
+
+    images, labels = load_npy_arrays(data_path, source)
+    with open(os.path.join(data_path, NPY_DIR, source, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    target_dir = os.path.join(data_path, NPY_DIR, target)
+    os.makedirs(target_dir, exist_ok=True)
+    images_path = os.path.join(target_dir, "images.npy")
+
+    poisoned = np.lib.format.open_memmap(
+        images_path, mode="w+", dtype=np.uint8, shape=images.shape
+    )
+    for start in range(0, len(images), 8192):
+        poisoned[start : start + 8192] = images[start : start + 8192]
+    poisoned.flush()
+    del poisoned
+
+    np.save(os.path.join(target_dir, "labels.npy"), np.asarray(labels))
+
+    class_rows = [
+        np.flatnonzero(labels == label) for label in range(len(manifest["class_names"]))
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(len(class_rows))
+
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        for future in [
+            executor.submit(
+                _poison_rows,
+                images_path,
+                rows,
+                num_to_poison,
+                amt_of_pixels,
+                acceptable_range,
+                class_seed,
+            )
+            for rows, class_seed in zip(class_rows, seeds)
+        ]:
+            future.result()
+
+    with open(os.path.join(target_dir, "manifest.json"), "w") as f:
+        json.dump(
+            manifest
+            | {
+                "split": target,
+                "poisoning": {
+                    "source": source,
+                    "num_to_poison": num_to_poison,
+                    "amt_of_pixels": amt_of_pixels,
+                    "acceptable_range": acceptable_range,
+                    "seed": seed,
+                },
+            },
+            f,
+            indent=2,
         )
-        # Create the directories if needed.
-        if not os.path.isdir(path + "train_poison/" + fldrs):
-            os.makedirs(path + "/train_poison/" + fldrs)
-        for pics in to_poison:
-            img = Image.open(pics)
-            pixel_map = img.load()
-            pixels_to_change = random.sample(pixel_list, k=amt_of_pixels)
-            for pixel in pixels_to_change:
-                # Select the pixel to change.
-                x = pixel[0]
-                y = pixel[1]
-                # Change each selected pixel by altering each channel by the range.
-                if not isinstance(pixel_map[x, y], int):
-                    pixel_map[x, y] = (
-                        int(
-                            random.uniform(
-                                pixel_map[x, y][0] * (1 - acceptable_range),
-                                pixel_map[x, y][0] * (1 + acceptable_range),
-                            )
-                        ),
-                        int(
-                            random.uniform(
-                                pixel_map[x, y][1] * (1 - acceptable_range),
-                                pixel_map[x, y][1] * (1 + acceptable_range),
-                            )
-                        ),
-                        int(
-                            random.uniform(
-                                pixel_map[x, y][2] * (1 - acceptable_range),
-                                pixel_map[x, y][2] * (1 + acceptable_range),
-                            )
-                        ),
-                    )
-
-                # If the image is greyscale we instead change the intensity.
-                else:
-                    pixel_map[x, y] = int(
-                        random.uniform(
-                            pixel_map[x, y] * (1 - acceptable_range),
-                            pixel_map[x, y] * (1 + acceptable_range),
-                        )
-                    )
-            # Generate the new filename.
-            new_name = img.filename.split("/")[-1].split(".")[0] + "_poisoned.png"
-            # Save the new image to the selected folder.
-            img.save(path + "train_poison/" + fldrs + "/" + new_name)
+
+    return target_dir
 
 
 if __name__ == "__main__":
-    poison_data()
+    parser = argparse.ArgumentParser(description="Generate data-poisoned images")
+    parser.add_argument("--path", type=str, default="/root/data/cinic-10/")
+    parser.add_argument(
+        "--format",
+        choices=["png", "npy"],
+        default="png",
+        help="write poisoned PNGs to train_poison/ or a pre-decoded split",
+    )
+    parser.add_argument("--num-to-poison", type=int, default=10)
+    parser.add_argument("--amt-of-pixels", type=int, default=100)
+    parser.add_argument("--acceptable-range", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.format == "png":
+        poison_data(
+            args.num_to_poison,
+            args.path,
+            args.amt_of_pixels,
+            args.acceptable_range,
+            seed=args.seed,
+            workers=args.workers,
+        )
+    else:
+        poison_split(
+            args.path,
+            args.num_to_poison,
+            args.amt_of_pixels,
+            args.acceptable_range,
+            seed=args.seed,
+            workers=args.workers,
+        )
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from typing import Iterable, Optional
+
+    import flwr as fl  # type: ignore
+
+
+class RunningWeightedAverage:
+    """Weighted average of model weights, folded in one update at a time.
+
+    Only the running sum is kept, so memory does not grow with the number of
+    updates. The additions happen in the same order and precision as in
+    `fl.server.strategy.aggregate.aggregate`, which gives bitwise identical
+    results for the same sequence of updates.
+    """
+
+    def __init__(self) -> None:
+        self.total: Optional[fl.common.Weights] = None
+        self.num_examples = 0
+        self.count = 0
+
+    def add(self, weights: fl.common.Weights, num_examples: int) -> None:
+        if self.total is None:
+            self.total = [layer * num_examples for layer in weights]
+        else:
+            for total, layer in zip(self.total, weights):
+                np.add(total, layer * num_examples, out=total)
+
+        self.num_examples += num_examples
+        self.count += 1
+
+    def result(self) -> Optional[fl.common.Weights]:
+        if self.total is None:
+            return None
+
+        return [total / self.num_examples for total in self.total]
+
+
+# Robust aggregation rules, selected with the `defense` config section.
+DEFENSES = ("median", "trimmed_mean", "krum", "multi_krum", "norm_clipping")
+
+
+def flatten(weights: fl.common.Weights) -> np.ndarray:
+    return np.concatenate([layer.ravel() for layer in weights]).astype(np.float32)
+
+
+def unflatten(vector: np.ndarray, like: fl.common.Weights) -> fl.common.Weights:
+    weights = []
+    offset = 0
+    for layer in like:
+        weights.append(
+            vector[offset : offset + layer.size]
+            .reshape(layer.shape)
+            .astype(layer.dtype)
+        )
+        offset += layer.size
+
+    return weights
+
+
+def stack_updates(
+    updates: Iterable[fl.common.Weights], reference: fl.common.Weights, count: int
+) -> np.ndarray:
+    """Return the `count` updates, relative to `reference`, as the rows of one
+    float32 matrix."""
+    reference_vector = flatten(reference)
+    stacked = np.empty((count, len(reference_vector)), dtype=np.float32)
+    for row, weights in zip(stacked, updates):
+        np.subtract(flatten(weights), reference_vector, out=row)
+
+    return stacked
+
+
+def _chunks(size: int, chunk_size: int) -> Iterable[slice]:
+    for start in range(0, size, chunk_size):
+        yield slice(start, min(start + chunk_size, size))
+
+
+def row_norms(
+    updates: np.ndarray, center: Optional[np.ndarray] = None, chunk_size: int = 65536
+) -> np.ndarray:
+    """Return the Euclidean norm of every row, or its distance to `center`."""
+    squares = np.zeros(len(updates), dtype=np.float64)
+    for chunk in _chunks(updates.shape[1], chunk_size):
+        rows = updates[:, chunk].astype(np.float64)
+        if center is not None:
+            rows -= center[chunk]
+        squares += np.einsum("ij,ij->i", rows, rows)
+
+    return np.sqrt(squares)
+
+
+def weighted_mean(
+    updates: np.ndarray, weights: np.ndarray, chunk_size: int = 65536
+) -> np.ndarray:
+    mean = np.empty(updates.shape[1], dtype=np.float32)
+    weights = weights.astype(np.float64) / weights.sum()
+    for chunk in _chunks(updates.shape[1], chunk_size):
+        mean[chunk] = weights @ updates[:, chunk]
+
+    return mean
+
+
+def coordinate_median(updates: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    median = np.empty(updates.shape[1], dtype=np.float32)
+    for chunk in _chunks(updates.shape[1], chunk_size):
+        median[chunk] = np.median(updates[:, chunk], axis=0)
+
+    return median
+
+
+def trimmed_mean(
+    updates: np.ndarray, trim_ratio: float = 0.1, chunk_size: int = 65536
+) -> np.ndarray:
+    """Coordinate-wise mean of the rows, leaving out the `trim_ratio` largest
+    and smallest values of every coordinate."""
+    trim = min(int(trim_ratio * len(updates)), (len(updates) - 1) // 2)
+
+    mean = np.empty(updates.shape[1], dtype=np.float32)
+    for chunk in _chunks(updates.shape[1], chunk_size):
+        ordered = np.sort(updates[:, chunk], axis=0)
+        mean[chunk] = ordered[trim : len(updates) - trim].mean(axis=0)
+
+    return mean
+
+
+def pairwise_sq_distances(updates: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    distances = np.zeros((len(updates), len(updates)), dtype=np.float64)
+    for chunk in _chunks(updates.shape[1], chunk_size):
+        rows = updates[:, chunk].astype(np.float64)
+        squares = np.einsum("ij,ij->i", rows, rows)
+        distances += squares[:, None] + squares[None, :] - 2 * rows @ rows.T
+
+    return np.maximum(distances, 0)
+
+
+def krum_select(
+    updates: np.ndarray,
+    num_byzantine: int = 1,
+    num_selected: int = 1,
+    chunk_size: int = 65536,
+) -> np.ndarray:
+    """Return the indices of the `num_selected` rows with the lowest Krum score,
+    the sum of squared distances to their n - f - 2 closest neighbours."""
+    distances = pairwise_sq_distances(updates, chunk_size)
+    np.fill_diagonal(distances, np.inf)
+
+    neighbours = max(len(updates) - num_byzantine - 2, 1)
+    scores = np.sort(distances, axis=1)[:, :neighbours].sum(axis=1)
+
+    return np.argsort(scores, kind="stable")[:num_selected]
+
+
+def robust_aggregate(
+    updates: np.ndarray,
+    num_examples: np.ndarray,
+    method: str,
+    trim_ratio: float = 0.1,
+    num_byzantine: int = 1,
+    num_selected: Optional[int] = None,
+    max_norm: Optional[float] = None,
+    clip_factor: float = 3.0,
+    flag_factor: float = 3.0,
+    chunk_size: int = 65536,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Aggregate the stacked client updates with one of `DEFENSES`.
+
+    Returns the aggregated update and which clients the defense flagged:
+    those Krum did not select, those whose norm was clipped, or, for the
+    coordinate-wise rules, those farther than `flag_factor` times the median
+    distance from the aggregate. Norm clipping clips to `max_norm`, by
+    default `clip_factor` times the median norm, so that honest clients are
+    left alone. `updates` may be modified in place.
+    """
+    if method == "median":
+        aggregate = coordinate_median(updates, chunk_size)
+    elif method == "trimmed_mean":
+        aggregate = trimmed_mean(updates, trim_ratio, chunk_size)
+    elif method in ("krum", "multi_krum"):
+        if method == "krum":
+            num_selected = 1
+        elif num_selected is None:
+            num_selected = max(len(updates) - num_byzantine, 1)
+
+        selected = krum_select(updates, num_byzantine, num_selected, chunk_size)
+        flagged = np.ones(len(updates), dtype=bool)
+        flagged[selected] = False
+
+        return (
+            weighted_mean(updates[selected], num_examples[selected], chunk_size),
+            flagged,
+        )
+    elif method == "norm_clipping":
+        norms = row_norms(updates, chunk_size=chunk_size)
+        if max_norm is None:
+            max_norm = clip_factor * float(np.median(norms))
+
+        flagged = norms > max_norm
+        updates *= np.minimum(1, max_norm / np.maximum(norms, 1e-12))[:, None].astype(
+            np.float32
+        )
+
+        return weighted_mean(updates, num_examples, chunk_size), flagged
+    else:
+        raise ValueError(f"unknown defense {method}")
+
+    distances = row_norms(updates, aggregate, chunk_size)
+    return aggregate, distances > flag_factor * np.median(distances)
+
+
+def geometric_features(
+    updates: np.ndarray, reference: np.ndarray, chunk_size: int = 65536
+) -> dict[str, np.ndarray]:
+    """Return per client the norm of its weights, the distance of its weights
+    from `reference` and the cosine similarity of its update to the mean update
+    of the other clients. `updates` are relative to `reference`."""
+    count = len(updates)
+    mean = np.zeros(updates.shape[1], dtype=np.float64)
+    for chunk in _chunks(updates.shape[1], chunk_size):
+        mean[chunk] = updates[:, chunk].mean(axis=0, dtype=np.float64)
+
+    dots = np.zeros(count, dtype=np.float64)
+    for chunk in _chunks(updates.shape[1], chunk_size):
+        dots += updates[:, chunk] @ mean[chunk]
+
+    distances = row_norms(updates, chunk_size=chunk_size)
+
+    # Leaving a client out of the mean, so that a large update cannot pull the
+    # mean onto itself: the others' mean is (count * mean - update) / (count - 1).
+    others = max(count - 1, 1)
+    other_dots = (count * dots - distances**2) / others
+    other_norms = (
+        np.sqrt(
+            np.maximum(
+                count**2 * float(mean @ mean) - 2 * count * dots + distances**2, 0.0
+            )
+        )
+        / others
+    )
+
+    return {
+        "norm": row_norms(updates, -reference, chunk_size),
+        "distance": distances,
+        "cosine": other_dots / np.maximum(distances * other_norms, 1e-12),
+    }
+
+
+def _robust_z(values: np.ndarray, min_spread: float) -> np.ndarray:
+    """Median/MAD z-score of the log of `values`."""
+    logs = np.log(np.maximum(values, 1e-12))
+    median = np.median(logs)
+    spread = max(1.4826 * float(np.median(np.abs(logs - median))), min_spread)
+
+    return (logs - median) / spread
+
+
+def geometric_prefilter(
+    updates: np.ndarray,
+    reference: np.ndarray,
+    accept_cosine: float = 0.5,
+    accept_z: float = 1.5,
+    reject_cosine: float = 0.0,
+    reject_z: float = 4.0,
+    min_spread: float = 0.1,
+    min_clients: int = 5,
+    chunk_size: int = 65536,
+) -> tuple[np.ndarray, np.ndarray, dict[str, np.ndarray]]:
+    """Sort clients into obviously bad, obviously fine and ambiguous ones.
+
+    A client is rejected if it did not move away from `reference` at all, if
+    its weight norm or its distance from `reference` is an outlier by more
+    than `reject_z` robust standard deviations, or if its update points away
+    from the other clients'. It is accepted if both are within `accept_z` and
+    the cosine similarity is at least `accept_cosine`. Cohorts of fewer than
+    `min_clients` are too small for robust statistics, so none of their
+    clients is decided. Returns the rejected and accepted masks and the
+    features they are based on.
+    """
+    features = geometric_features(updates, reference, chunk_size)
+    if len(updates) < min_clients:
+        undecided = np.zeros(len(updates), dtype=bool)
+        return undecided, undecided.copy(), features
+
+    norm_z = np.abs(_robust_z(features["norm"], min_spread))
+    distance_z = np.abs(_robust_z(features["distance"], min_spread))
+
+    rejected = (
+        (features["distance"] <= 1e-12)
+        | (norm_z > reject_z)
+        | (distance_z > reject_z)
+        | (features["cosine"] < reject_cosine)
+    )
+    accepted = (
+        ~rejected
+        & (norm_z <= accept_z)
+        & (distance_z <= accept_z)
+        & (features["cosine"] >= accept_cosine)
+    )
+
+    return rejected, accepted, features
@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess  # nosec
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Optional
+
+logger = logging.getLogger("benchmark")
+
+NUM_CLASSES = 10
+CLASS_NAMES = [f"class_{label}" for label in range(NUM_CLASSES)]
+
+BENCHMARKS = (
+    "model",
+    "dataset",
+    "poisoning",
+    "logger",
+    "validation",
+    "aggregation",
+    "codec",
+    "resources",
+)
+
+
+def measure(
+    function: Callable[[], Any], items: int, repeat: int, memory: bool
+) -> dict[str, Any]:
+    """Time `repeat` calls of `function`, then trace one more call for its peak
+    Python heap usage."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    seconds = (time.perf_counter() - start) / repeat
+
+    result = {
+        "seconds": seconds,
+        "items": items,
+        "throughput": items / seconds if seconds else None,
+    }
+
+    if memory:
+        tracemalloc.start()
+        function()
+        result["peak_python_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    # The peak resident set size of the whole process so far, not of this
+    # case; Linux reports it in KiB.
+    result["process_max_rss_bytes"] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    )
+
+    return result
+
+
+def synthetic_images(rng: np.random.Generator, count: int) -> np.ndarray:
+    return rng.integers(0, 256, size=(count, 32, 32, 3), dtype=np.uint8)
+
+
+def synthetic_labels(rng: np.random.Generator, count: int) -> np.ndarray:
+    return np.arange(count) % NUM_CLASSES
+
+
+def write_synthetic_data(data_path: str, samples: int, seed: int) -> None:
+    """Write CINIC-shaped pre-decoded train, valid and test splits."""
+    from cinic10_ds import write_npy_split
+
+    rng = np.random.default_rng(seed)
+    for split in ("train", "valid", "test"):
+        write_npy_split(
+            data_path,
+            split,
+            synthetic_images(rng, samples),
+            synthetic_labels(rng, samples),
+            CLASS_NAMES,
+        )
+
+
+def write_synthetic_pngs(directory: str, per_class: int, seed: int) -> None:
+    from PIL import Image  # type: ignore
+
+    rng = np.random.default_rng(seed)
+    for class_name in CLASS_NAMES:
+        os.makedirs(os.path.join(directory, class_name), exist_ok=True)
+        for index, image in enumerate(synthetic_images(rng, per_class)):
+            Image.fromarray(image).save(
+                os.path.join(directory, class_name, f"{index}.png")
+            )
+
+
+def synthetic_client_weights(
+    base: list[np.ndarray], rng: np.random.Generator, poisoning: str
+) -> list[np.ndarray]:
+    """Return weights like a client with the given poisoning mode would."""
+    if poisoning == "lazy":
+        return [layer.copy() for layer in base]
+    if poisoning == "model":
+        return [rng.normal(0, 0.05, layer.shape).astype(layer.dtype) for layer in base]
+
+    return [
+        layer + rng.normal(0, 1e-3, layer.shape).astype(layer.dtype) for layer in base
+    ]
+
+
+def synthetic_results(
+    base: list[np.ndarray], num_clients: int, seed: int, poisoned_fraction: float
+) -> list[tuple[Any, Any]]:
+    """Return `fit` results of honest and poisoned clients.
+
+    Clients only need an id and cached properties here, so plain namespaces
+    stand in for client proxies.
+    """
+    import flwr as fl  # type: ignore
+
+    rng = np.random.default_rng(seed)
+    num_poisoned = int(round(poisoned_fraction * num_clients))
+
+    results = []
+    for index in range(num_clients):
+        poisoning = ("model", "lazy")[index % 2] if index < num_poisoned else "None"
+        client_proxy = types.SimpleNamespace(
+            cid=str(index), properties={"poisoning": poisoning}
+        )
+        fit_res = fl.common.FitRes(
+            parameters=fl.common.weights_to_parameters(
+                synthetic_client_weights(base, rng, poisoning)
+            ),
+            num_examples=1000,
+            metrics={},
+        )
+        results.append((client_proxy, fit_res))
+
+    return results
+
+
+def bench_model(args: argparse.Namespace) -> list[dict[str, Any]]:
+    from model import ModelPool, create_model
+
+    model_pool = ModelPool(1, prebuild=1)
+
+    return [
+        {
+            "benchmark": "create_model",
+            "params": {},
+            "unit": "models/s",
+            **measure(create_model, 1, args.repeat, args.memory),
+        },
+        {
+            "benchmark": "ModelPool.initial_weights",
+            "params": {},
+            "unit": "models/s",
+            **measure(model_pool.initial_weights, 1, args.repeat, args.memory),
+        },
+    ]
+
+
+def bench_dataset(args: argparse.Namespace) -> list[dict[str, Any]]:
+    import cinic10_ds
+
+    records = []
+    directory = os.path.join(args.data_path, "png", "valid")
+    write_synthetic_pngs(directory, args.samples // NUM_CLASSES, args.seed)
+    png_count = args.samples // NUM_CLASSES * NUM_CLASSES
+
+    sources = {
+        "npy": (lambda: cinic10_ds.get_dataset(args.data_path, "valid"), args.samples),
+        "png": (
+            lambda: cinic10_ds.get_dataset(
+                os.path.join(args.data_path, "png"), "valid"
+            ),
+            png_count,
+        ),
+    }
+
+    for source, (build, count) in sources.items():
+
+        def construct() -> None:
+            cinic10_ds._registry.clear()
+            build()
+
+        def iterate() -> None:
+            for _ in build():
+                pass
+
+        records.append(
+            {
+                "benchmark": "dataset_construction",
+                "params": {"source": source},
+                "unit": "datasets/s",
+                **measure(construct, 1, args.repeat, args.memory),
+            }
+        )
+        records.append(
+            {
+                "benchmark": "dataset_iteration",
+                "params": {"source": source},
+                "unit": "images/s",
+                **measure(iterate, count, args.repeat, args.memory),
+            }
+        )
+
+    return records
+
+
+def bench_poisoning(args: argparse.Namespace) -> list[dict[str, Any]]:
+    from DataPoisoning import poison_data
+
+    path = os.path.join(args.data_path, "poisoning") + "/"
+    per_class = max(args.samples // NUM_CLASSES, 1)
+    write_synthetic_pngs(os.path.join(path, "train"), per_class, args.seed)
+
+    return [
+        {
+            "benchmark": "poison_data",
+            "params": {"images_per_class": per_class},
+            "unit": "images/s",
+            **measure(
+                lambda: poison_data(per_class, path, seed=args.seed),
+                per_class * NUM_CLASSES,
+                args.repeat,
+                args.memory,
+            ),
+        }
+    ]
+
+
+def bench_logger(args: argparse.Namespace) -> list[dict[str, Any]]:
+    from logger import DictLogger
+
+    records = []
+    for backend in ("json", "jsonl"):
+        for size in (10, 100, 1000, 10000):
+            DictLogger._json_file_name = os.path.join(
+                args.data_path, f"log-{backend}-{size}.json"
+            )
+            DictLogger.use_backend(backend)
+            logger = DictLogger()
+
+            # Start from `size` entries, as if that many had been logged.
+            DictLogger.content = {
+                f"entry_{key}": {"round": key, "accuracy": 0.5} for key in range(size)
+            }
+
+            calls = 100
+
+            def log_calls() -> None:
+                for key in range(calls):
+                    logger.log({f"extra_{key}": {"round": key, "accuracy": 0.5}})
+
+            records.append(
+                {
+                    "benchmark": "dictlogger_log",
+                    "params": {"backend": backend, "content_size": size},
+                    "unit": "calls/s",
+                    **measure(log_calls, calls, args.repeat, args.memory),
+                }
+            )
+            DictLogger.close()
+
+    return records
+
+
+def bench_validation(args: argparse.Namespace) -> list[dict[str, Any]]:
+    from model import create_model
+    from validation_server import ValidationServer
+
+    base = create_model().get_weights()
+
+    records = []
+    for references in args.references:
+        validator = ValidationServer(
+            num_of_models=references, data_path=args.data_path, mode=args.mode
+        )
+        for num_clients in args.clients:
+            results = synthetic_results(
+                base, num_clients, args.seed, args.poisoned_fraction
+            )
+            records.append(
+                {
+                    "benchmark": "validate_clients",
+                    "params": {
+                        "clients": num_clients,
+                        "references": validator.num_of_models,
+                        "mode": args.mode,
+                    },
+                    "unit": "clients/s",
+                    **measure(
+                        lambda: validator.validate_clients(results),
+                        num_clients,
+                        args.repeat,
+                        args.memory,
+                    ),
+                }
+            )
+        validator.close()
+
+    return records
+
+
+def bench_aggregation(args: argparse.Namespace) -> list[dict[str, Any]]:
+    import server
+    from model import create_model
+
+    base = create_model().get_weights()
+    defenses = [None] + [{"method": method} for method in args.defenses]
+
+    # All cases record into the same metrics store, so each of their rounds
+    # gets a number of its own.
+    rounds = itertools.count(1)
+
+    records = []
+    for defense in defenses:
+        for references in args.references if defense is None else [None]:
+            for num_clients in args.clients:
+                strategy = server.SaveModelStrategy(
+                    data_path=args.data_path,
+                    num_fl_clients=num_clients,
+                    poisoned_client_selection="random",
+                    validation={"num_of_models": references, "mode": args.mode},
+                    defense=defense,
+                )
+                strategy.client_manager = server.PropertiesClientManager()
+                strategy.global_weights = base
+                results = synthetic_results(
+                    base, num_clients, args.seed, args.poisoned_fraction
+                )
+
+                def aggregate() -> None:
+                    strategy.blacklist = set()
+                    strategy.aggregate_fit(next(rounds), results, [])
+
+                record = {
+                    "benchmark": "aggregate_fit",
+                    "params": {
+                        "clients": num_clients,
+                        "references": references,
+                        "defense": defense and defense["method"],
+                    },
+                    "unit": "clients/s",
+                    **measure(aggregate, num_clients, args.repeat, args.memory),
+                }
+
+                # Detection quality of the last measured round.
+                last_round = next(rounds) - 1
+                for metric in ("detection_precision", "detection_recall"):
+                    record[metric] = server.metrics_store.per_round(
+                        metric, clients=["server"], rounds=[last_round]
+                    ).get(last_round)
+
+                records.append(record)
+
+                if strategy.validator is not None:
+                    strategy.validator.close()
+
+    return records
+
+
+def bench_codec(args: argparse.Namespace) -> list[dict[str, Any]]:
+    from cinic10_ds import get_arrays
+    from codec import CODECS, decode_weights, encode_weights, weights_nbytes
+    from evaluator import compute_metrics, predict
+    from model import create_model
+
+    # One epoch moves the BatchNorm statistics away from their initial values.
+    model = create_model()
+    images, labels = get_arrays(args.data_path, "train")
+    model.fit(
+        images.astype(np.float32),
+        np.eye(NUM_CLASSES)[labels],
+        batch_size=64,
+        epochs=1,
+        verbose=0,
+    )
+    weights = model.get_weights()
+
+    valid_images, valid_labels = get_arrays(args.data_path, "valid")
+    probabilities = predict(model, valid_images)
+    accuracy = compute_metrics(probabilities, valid_labels, ["accuracy"])["accuracy"]
+
+    records = []
+    for codec in CODECS:
+        decoded = decode_weights(encode_weights(weights, codec), codec)
+        model.set_weights(decoded)
+        codec_probabilities = predict(model, valid_images)
+        codec_accuracy = compute_metrics(
+            codec_probabilities, valid_labels, ["accuracy"]
+        )["accuracy"]
+
+        records.append(
+            {
+                "benchmark": "codec_round_trip",
+                "params": {"codec": codec},
+                "unit": "models/s",
+                **measure(
+                    lambda: decode_weights(encode_weights(weights, codec), codec),
+                    1,
+                    args.repeat,
+                    args.memory,
+                ),
+                "compression": weights_nbytes(weights)
+                / weights_nbytes(encode_weights(weights, codec)),
+                "max_abs_error": max(
+                    float(np.abs(layer - decoded_layer).max(initial=0))
+                    for layer, decoded_layer in zip(weights, decoded)
+                ),
+                "accuracy": codec_accuracy,
+                "accuracy_difference": codec_accuracy - accuracy,
+                "prediction_agreement": float(
+                    np.mean(
+                        codec_probabilities.argmax(axis=-1)
+                        == probabilities.argmax(axis=-1)
+                    )
+                ),
+            }
+        )
+        model.set_weights(weights)
+
+    return records
+
+
+def train_in_container(data_path: str, plan: Optional[dict[str, Any]]) -> None:
+    """Train one epoch like a client container, under `plan` if given."""
+    if plan is not None:
+        from runner import apply_resources
+
+        apply_resources(plan)
+
+    from cinic10_ds import get_arrays
+    from model import create_model
+
+    images, labels = get_arrays(data_path, "train")
+    create_model().fit(
+        images.astype(np.float32),
+        np.eye(NUM_CLASSES)[labels],
+        batch_size=64,
+        epochs=1,
+        verbose=0,
+    )
+
+
+def bench_resources(args: argparse.Namespace) -> list[dict[str, Any]]:
+    import multiprocessing
+
+    from runner import plan_resources
+
+    context = multiprocessing.get_context("spawn")
+
+    records = []
+    for containers in args.containers:
+        config = {"containers_per_machine": containers, "resources": {}}
+        plans: dict[str, list[Optional[dict[str, Any]]]] = {
+            "planned": [
+                plan_resources(config, None, index) for index in range(containers)
+            ],
+            "unplanned": [None] * containers,
+        }
+
+        for name, container_plans in plans.items():
+
+            def run() -> None:
+                processes = [
+                    context.Process(
+                        target=train_in_container, args=(args.data_path, plan)
+                    )
+                    for plan in container_plans
+                ]
+                for process in processes:
+                    process.start()
+                for process in processes:
+                    process.join()
+                    if process.exitcode != 0:
+                        raise RuntimeError(f"container exited with {process.exitcode}")
+
+            # The containers run in processes of their own, so the parent's
+            # Python heap says nothing about them.
+            records.append(
+                {
+                    "benchmark": "host_training",
+                    "params": {
+                        "containers": containers,
+                        "resources": name,
+                        "cpus": len(os.sched_getaffinity(0)),
+                    },
+                    "unit": "images/s",
+                    **measure(run, containers * args.samples, args.repeat, False),
+                }
+            )
+
+    return records
+
+
+def compare(old_path: str, new_path: str) -> None:
+    """Print the throughput ratio of every benchmark present in both files."""
+
+    def key(record: dict[str, Any]) -> str:
+        return record["benchmark"] + json.dumps(record["params"], sort_keys=True)
+
+    with open(old_path) as f:
+        old = {key(record): record for record in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = {key(record): record for record in json.load(f)["results"]}
+
+    for name in sorted(old.keys() & new.keys()):
+        if old[name]["throughput"] and new[name]["throughput"]:
+            logger.info(
+                "%8.2fx  %s", new[name]["throughput"] / old[name]["throughput"], name
+            )
+
+
+def get_revision() -> str:
+    try:
+        return subprocess.run(  # nosec
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot paths on synthetic CINIC-shaped data"
+    )
+    parser.add_argument("--output", type=str, default="benchmark.json")
+    parser.add_argument(
+        "--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS)
+    )
+    parser.add_argument("--clients", nargs="+", type=int, default=[4, 16])
+    parser.add_argument("--references", nargs="+", type=int, default=[1, 3])
+    parser.add_argument(
+        "--containers",
+        nargs="+",
+        type=int,
+        default=[1, 2, 4],
+        help="client containers training at once in the resources benchmark",
+    )
+    parser.add_argument(
+        "--defenses",
+        nargs="+",
+        default=["median", "trimmed_mean", "krum", "multi_krum", "norm_clipping"],
+    )
+    parser.add_argument(
+        "--mode", choices=["exhaustive", "sequential", "pool"], default="exhaustive"
+    )
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--poisoned-fraction", type=float, default=0.25)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="skip the extra traced run measuring peak Python heap usage",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="compare two result files instead of running benchmarks",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    output = os.path.abspath(args.output)
+
+    with tempfile.TemporaryDirectory() as data_path:
+        args.data_path = data_path
+        # The server module keeps its logs and metrics in the working directory.
+        os.chdir(data_path)
+
+        write_synthetic_data(data_path, args.samples, args.seed)
+
+        functions = {
+            "model": bench_model,
+            "dataset": bench_dataset,
+            "poisoning": bench_poisoning,
+            "logger": bench_logger,
+            "validation": bench_validation,
+            "aggregation": bench_aggregation,
+            "codec": bench_codec,
+            "resources": bench_resources,
+        }
+
+        results = []
+        for name in args.only:
+            logger.info("Running %s benchmarks", name)
+            results.extend(functions[name](args))
+
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "revision": get_revision(),
+                "python": sys.version,
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+                "arguments": {
+                    name: value
+                    for name, value in vars(args).items()
+                    if name not in ("data_path", "compare")
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+    logger.info("Wrote %s", output)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import glob
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+    from typing import Any, Callable, Optional
+
+    import flwr as fl  # type: ignore
+
+
+def checkpoint_path(directory: str, rnd: int) -> str:
+    return os.path.join(directory, f"round-{rnd:05d}.npz")
+
+
+def latest_checkpoint(directory: str) -> Optional[str]:
+    paths = sorted(glob.glob(os.path.join(directory, "round-*.npz")))
+    return paths[-1] if paths else None
+
+
+def pack_state(
+    rnd: int,
+    global_weights: fl.common.Weights,
+    reference_weights: list[fl.common.Weights],
+    model_versions: list[int],
+    blacklist: set[str],
+    metadata: dict[str, Any],
+) -> dict[str, np.ndarray]:
+    """Flatten the state of a round into named arrays for `np.savez`."""
+    arrays = {f"global_{index}": layer for index, layer in enumerate(global_weights)}
+
+    for slot, weights in enumerate(reference_weights):
+        arrays |= {
+            f"reference_{slot}_{index}": layer for index, layer in enumerate(weights)
+        }
+
+    arrays["model_versions"] = np.array(model_versions, dtype=np.int64)
+    arrays["blacklist"] = np.array(sorted(blacklist), dtype=np.str_)
+    arrays["metadata"] = np.array(
+        json.dumps(metadata | {"round": rnd, "references": len(reference_weights)})
+    )
+
+    return arrays
+
+
+def load_state(path: str) -> dict[str, Any]:
+    """Invert `pack_state`."""
+    with np.load(path) as arrays:
+        metadata = json.loads(str(arrays["metadata"]))
+
+        def layers(prefix: str) -> list[np.ndarray]:
+            count = sum(name.startswith(prefix) for name in arrays.files)
+            return [arrays[f"{prefix}{index}"] for index in range(count)]
+
+        return {
+            "round": metadata["round"],
+            "global_weights": layers("global_"),
+            "reference_weights": [
+                layers(f"reference_{slot}_") for slot in range(metadata["references"])
+            ],
+            "model_versions": arrays["model_versions"].tolist(),
+            "blacklist": set(arrays["blacklist"].tolist()),
+            "metadata": metadata,
+        }
+
+
+class Checkpointer:
+    """Writes round checkpoints in a background thread.
+
+    `save` returns right away, so the arrays given to it must not be modified
+    afterwards. The file is written to a temporary name and renamed once
+    complete, so a crash never leaves a truncated checkpoint behind. Only the
+    `keep` most recent checkpoints are kept. `on_written` is called with the round, the
+    write time and the file size.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        every: int = 1,
+        keep: int = 2,
+        compress: bool = False,
+        on_written: Optional[Callable[[int, float, int], None]] = None,
+    ):
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+        self.compress = compress
+        self.on_written = on_written
+
+        os.makedirs(directory, exist_ok=True)
+
+        # One writer, so checkpoints are written in round order.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._last_write: Optional[Future] = None
+
+    def due(self, rnd: int) -> bool:
+        return rnd % self.every == 0
+
+    def save(self, rnd: int, arrays: dict[str, np.ndarray]) -> None:
+        self._last_write = self._executor.submit(self._write, rnd, arrays)
+
+    def _write(self, rnd: int, arrays: dict[str, np.ndarray]) -> None:
+        start = time.perf_counter()
+
+        path = checkpoint_path(self.directory, rnd)
+        with open(path + ".tmp", "wb") as f:
+            # numpy's stubs would check the arrays against `allow_pickle`.
+            named_arrays: dict[str, Any] = arrays
+            if self.compress:
+                np.savez_compressed(f, **named_arrays)
+            else:
+                np.savez(f, **named_arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        for old_path in sorted(glob.glob(os.path.join(self.directory, "round-*.npz")))[
+            : -self.keep
+        ]:
+            os.remove(old_path)
+
+        if self.on_written is not None:
+            self.on_written(rnd, time.perf_counter() - start, os.path.getsize(path))
+
+    def close(self) -> None:
+        """Wait for the pending checkpoint, raising its error if it failed."""
+        self._executor.shutdown(wait=True)
+        if self._last_write is not None:
+            self._last_write.result()
@@ -2,56 +2,552 @@
 
 from __future__ import annotations
 
+import json
 import os
-import pathlib
+import threading
+from typing import TYPE_CHECKING
 
+import numpy as np
 import tensorflow as tf  # type: ignore
 
+if TYPE_CHECKING:
+    from typing import Any, Callable, Optional
+
 batch_size = 32
 
+img_height = 32
+img_width = 32
 
-def get_train_ds(data_path: str, subdir: str = None) -> tf.data.Dataset:
-    train_data_dir = pathlib.Path(os.path.join(data_path, subdir or "train"))
+# How shared pipelines cache decoded images: None, "memory" or a file path
+# prefix for an on-disk cache.
+cache: Optional[str] = None
+
+# Dataset splits and the directories, relative to the data path, holding them.
+SPLITS = {
+    "train": "train/train",
+    "train_label_poison": "train/train_label_poison",
+    "train_data_poison": "train/train_data_poison",
+    "valid": "valid",
+    "test": "test",
+}
+
+# Directory, relative to the data path, holding the pre-decoded splits.
+NPY_DIR = "npy"
+
+IMAGE_EXTENSIONS = (".bmp", ".gif", ".jpeg", ".jpg", ".png")
+
+
+def get_split_name(subdir: str) -> Optional[str]:
+    for split, split_dir in SPLITS.items():
+        if split_dir == subdir.strip("/"):
+            return split
+
+    return None
+
+
+def has_npy_split(data_path: str, split: str) -> bool:
+    return os.path.isfile(os.path.join(data_path, NPY_DIR, split, "manifest.json"))
+
+
+def list_image_files(directory: str) -> tuple[list[str], list[int], list[str]]:
+    """Return image paths, labels and class names of a class-per-folder
+    directory, ordered like `tf.keras.utils.image_dataset_from_directory`."""
+    class_names = sorted(
+        entry
+        for entry in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, entry))
+    )
+
+    paths = []
+    labels = []
+    for label, class_name in enumerate(class_names):
+        for root, _, files in sorted(os.walk(os.path.join(directory, class_name))):
+            for file_name in sorted(files):
+                if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(root, file_name))
+                    labels.append(label)
+
+    return paths, labels, class_names
 
-    img_height = 32
-    img_width = 32
 
-    train_folder = tf.keras.utils.image_dataset_from_directory(
-        train_data_dir,
-        seed=42,
-        image_size=(img_height, img_width),
-        batch_size=batch_size,
-        labels="inferred",
-        label_mode="categorical",
+def decode_image(path: tf.Tensor) -> tf.Tensor:
+    """Decode an image file the way `image_dataset_from_directory` does."""
+    image = tf.io.decode_image(
+        tf.io.read_file(path), channels=3, expand_animations=False
     )
+    image = tf.image.resize(image, (img_height, img_width))
+    image.set_shape((img_height, img_width, 3))
+    return image
+
+
+def convert_split(data_path: str, split: str) -> str:
+    """Decode every image of a split once and store the split as a contiguous
+    uint8 image array, a label array and a manifest under `NPY_DIR`, where
+    `get_dataset` looks for them.
+
+    Returns the directory the split was written to.
+    """
+    output_dir = os.path.join(data_path, NPY_DIR, split)
+    os.makedirs(output_dir, exist_ok=True)
+
+    paths, labels, class_names = list_image_files(
+        os.path.join(data_path, SPLITS[split])
+    )
+
+    images = np.lib.format.open_memmap(
+        os.path.join(output_dir, "images.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(paths), img_height, img_width, 3),
+    )
+
+    decoded = (
+        tf.data.Dataset.from_tensor_slices(paths)
+        .map(
+            lambda path: tf.cast(tf.round(decode_image(path)), tf.uint8),
+            num_parallel_calls=tf.data.AUTOTUNE,
+        )
+        .batch(1024)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+
+    offset = 0
+    for image_batch in decoded:
+        images[offset : offset + len(image_batch)] = image_batch.numpy()
+        offset += len(image_batch)
+    images.flush()
+    del images
+
+    np.save(os.path.join(output_dir, "labels.npy"), np.asarray(labels, dtype=np.uint8))
+
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump(
+            {
+                "split": split,
+                "count": len(paths),
+                "shape": [img_height, img_width, 3],
+                "dtype": "uint8",
+                "class_names": class_names,
+            },
+            f,
+            indent=2,
+        )
+
+    return output_dir
+
+
+def write_npy_split(
+    data_path: str,
+    split: str,
+    images: np.ndarray,
+    labels: np.ndarray,
+    class_names: list[str],
+) -> str:
+    """Store in-memory uint8 images and labels as a split in the format of
+    `convert_split`. Returns the directory the split was written to."""
+    output_dir = os.path.join(data_path, NPY_DIR, split)
+    os.makedirs(output_dir, exist_ok=True)
+
+    np.save(os.path.join(output_dir, "images.npy"), images.astype(np.uint8))
+    np.save(os.path.join(output_dir, "labels.npy"), labels.astype(np.uint8))
+
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump(
+            {
+                "split": split,
+                "count": len(labels),
+                "shape": list(images.shape[1:]),
+                "dtype": "uint8",
+                "class_names": class_names,
+            },
+            f,
+            indent=2,
+        )
+
+    return output_dir
+
+
+def load_npy_arrays(data_path: str, split: str) -> tuple[np.ndarray, np.ndarray]:
+    """Memory-map the image and label arrays of a split written by
+    `convert_split`."""
+    split_dir = os.path.join(data_path, NPY_DIR, split)
+
+    return (
+        np.load(os.path.join(split_dir, "images.npy"), mmap_mode="r"),
+        np.load(os.path.join(split_dir, "labels.npy"), mmap_mode="r"),
+    )
+
+
+def get_npy_ds(
+    data_path: str,
+    split: str,
+    shuffle: bool = True,
+    seed: int = 42,
+    in_memory: bool = False,
+) -> tf.data.Dataset:
+    """Load a split written by `convert_split`.
+
+    The arrays are memory-mapped, so co-located processes share the page cache
+    and only the current batch is copied out of it. `in_memory` reads them into
+    process memory instead.
+    """
+    split_dir = os.path.join(data_path, NPY_DIR, split)
+
+    with open(os.path.join(split_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    images, labels = load_npy_arrays(data_path, split)
+    if in_memory:
+        images, labels = np.array(images), np.array(labels)
+    num_classes = len(manifest["class_names"])
+
+    def load_batch(indices: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        return images[indices].astype(np.float32), labels[indices].astype(np.int64)
+
+    def to_tensors(indices: tf.Tensor) -> tuple[tf.Tensor, tf.Tensor]:
+        image_batch, label_batch = tf.numpy_function(
+            load_batch, [indices], (tf.float32, tf.int64)
+        )
+        image_batch.set_shape((None, img_height, img_width, 3))
+        label_batch.set_shape((None,))
+        return image_batch, tf.one_hot(label_batch, num_classes)
+
+    dataset = tf.data.Dataset.range(len(labels))
+    if shuffle:
+        dataset = dataset.shuffle(len(labels), seed=seed)
+
+    return dataset.batch(batch_size).map(
+        to_tensors, num_parallel_calls=tf.data.AUTOTUNE
+    )
+
+
+def get_directory_ds(
+    directory: str,
+    shuffle: bool = True,
+    seed: int = 42,
+    cache_to: Optional[str] = None,
+) -> tf.data.Dataset:
+    """Load a class-per-folder image directory like
+    `image_dataset_from_directory`, decoding in parallel and optionally caching
+    the decoded images in memory ("memory") or in files with the given prefix."""
+    paths, labels, class_names = list_image_files(directory)
+
+    if shuffle:
+        # Shuffle the file list once, like `image_dataset_from_directory`.
+        order = np.random.RandomState(seed).permutation(len(paths))
+        paths = [paths[index] for index in order]
+        labels = [labels[index] for index in order]
+
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels)).map(
+        lambda path, label: (decode_image(path), tf.one_hot(label, len(class_names))),
+        num_parallel_calls=tf.data.AUTOTUNE,
+    )
+
+    if cache_to is not None:
+        dataset = dataset.cache("" if cache_to == "memory" else cache_to)
+
+    if shuffle:
+        dataset = dataset.shuffle(batch_size * 8, seed=seed)
+
+    return dataset.batch(batch_size)
+
+
+_registry: dict[tuple, tf.data.Dataset] = {}
+_registry_lock = threading.Lock()
+
+
+def get_dataset(
+    data_path: str, split_dir: str, shuffle: Optional[bool] = None
+) -> tf.data.Dataset:
+    """Return the process-wide shared pipeline of a split, building it on first
+    use.
 
-    return train_folder
+    `split_dir` is the split's directory relative to `data_path`. Training splits
+    are shuffled unless told otherwise. Decoded images are cached according to
+    the module-level `cache` setting and batches are prefetched.
+    """
+    split_dir = split_dir.strip("/")
+    if shuffle is None:
+        shuffle = split_dir.startswith("train")
+
+    key = (os.path.abspath(data_path), split_dir, shuffle, cache)
+
+    with _registry_lock:
+        if key not in _registry:
+            split = get_split_name(split_dir)
+
+            if split is not None and has_npy_split(data_path, split):
+                dataset = get_npy_ds(
+                    data_path, split, shuffle=shuffle, in_memory=cache == "memory"
+                )
+            else:
+                cache_to = cache
+                if cache_to is not None and cache_to != "memory":
+                    cache_to = f"{cache_to}-{split_dir.replace('/', '_')}"
+
+                dataset = get_directory_ds(
+                    os.path.join(data_path, split_dir),
+                    shuffle=shuffle,
+                    cache_to=cache_to,
+                )
+
+            _registry[key] = dataset.prefetch(tf.data.AUTOTUNE)
+
+        return _registry[key]
+
+
+def get_train_ds(data_path: str, subdir: str = None) -> tf.data.Dataset:
+    return get_dataset(data_path, subdir or "train")
 
 
 def get_test_val_ds(data_path: str) -> tf.data.Dataset:
+    return get_dataset(data_path, SPLITS["test"]), get_dataset(
+        data_path, SPLITS["valid"]
+    )
+
+
+# Random weights of the pixel fingerprint of `_sample_keys`.
+_KEY_WEIGHTS = np.random.default_rng(0).integers(
+    1, 1 << 20, size=(img_height, img_width, 3)
+)
+
+
+def _sample_keys(images: tf.Tensor) -> tf.Tensor:
+    """Return a key per image of a batch that only depends on its pixels.
+
+    Poisoning is seeded with these keys instead of the batch position, which
+    changes with every shuffle, so the same samples are poisoned the same way
+    in every epoch, like in a pre-poisoned copy of the dataset.
+    """
+    return tf.reduce_sum(
+        tf.cast(images, tf.int64) * tf.constant(_KEY_WEIGHTS, dtype=tf.int64),
+        axis=[1, 2, 3],
+    )
+
+
+_HASH_MASK = 0xFFFFFFFF
+
 
-    val_data_dir = pathlib.Path(os.path.join(data_path, "valid"))
-    test_data_dir = pathlib.Path(os.path.join(data_path, "test"))
+def _hash(values: tf.Tensor) -> tf.Tensor:
+    """Mix int64 values in [0, 2**32) into well spread ones in the same range.
 
-    img_height = 32
-    img_width = 32
+    The multipliers stay below 2**31, so no product overflows int64.
+    """
+    for multiplier in (0x7FEB352D, 0x2C1B3C6D):
+        values = tf.bitwise.bitwise_xor(values, tf.bitwise.right_shift(values, 16))
+        values = tf.bitwise.bitwise_and(values * multiplier, _HASH_MASK)
 
-    test_folder = tf.keras.utils.image_dataset_from_directory(
-        test_data_dir,
-        seed=42,
-        image_size=(img_height, img_width),
-        batch_size=batch_size,
-        labels="inferred",
-        label_mode="categorical",
+    return tf.bitwise.bitwise_xor(values, tf.bitwise.right_shift(values, 16))
+
+
+def _sample_uniform(
+    seed: int,
+    stream: int,
+    keys: tf.Tensor,
+    shape: tuple[int, ...] = (),
+    minval: float = 0.0,
+    maxval: float = 1.0,
+) -> tf.Tensor:
+    """Return uniform floats shaped (keys, *shape) that only depend on `seed`,
+    the `stream` of the draw and the key of their sample.
+
+    Every value hashes its sample's key with its position, so the whole batch
+    is drawn at once, in the same way for a sample wherever it is in a batch.
+    """
+    offset = tf.constant(
+        (seed * 0x9E3779B9 + stream * 0x85EBCA6B) & _HASH_MASK, dtype=tf.int64
+    )
+    base = _hash(
+        tf.bitwise.bitwise_xor(
+            _hash(
+                tf.bitwise.bitwise_xor(
+                    tf.bitwise.bitwise_and(keys, _HASH_MASK), _hash(offset)
+                )
+            ),
+            tf.bitwise.right_shift(keys, 32),
+        )
     )
 
-    val_folder = tf.keras.utils.image_dataset_from_directory(
-        val_data_dir,
-        seed=42,
-        image_size=(img_height, img_width),
-        batch_size=batch_size,
-        labels="inferred",
-        label_mode="categorical",
+    size = int(np.prod(shape, dtype=np.int64))
+    counters = _hash(tf.reshape(tf.range(size, dtype=tf.int64), shape))
+    values = _hash(
+        tf.bitwise.bitwise_xor(
+            tf.reshape(base, [-1] + [1] * len(shape)), counters[None]
+        )
     )
 
-    return test_folder, val_folder
+    # 24 bits are exact in float32, so the values stay below 1.
+    uniform = tf.cast(tf.bitwise.right_shift(values, 8), tf.float32) / float(1 << 24)
+    return minval + (maxval - minval) * uniform
+
+
+def label_flip(
+    mapping: Optional[dict[int, int]] = None,
+    rate: float = 1.0,
+    seed: int = 0,
+    num_classes: int = 10,
+) -> Callable[[tf.data.Dataset], tf.data.Dataset]:
+    """Return a dataset transformation that relabels a `rate` fraction of the
+    samples of a batched dataset according to `mapping`.
+
+    Labels missing from `mapping` are kept; without a mapping every class c is
+    relabelled as `num_classes - 1 - c`. Which samples are relabelled only
+    depends on `seed` and the samples themselves.
+    """
+    table = list(range(num_classes - 1, -1, -1))
+    if mapping is not None:
+        table = [int(mapping.get(label, label)) for label in range(num_classes)]
+    table = tf.constant(table, dtype=tf.int64)
+
+    def flip(images: tf.Tensor, labels: tf.Tensor) -> tuple[tf.Tensor, tf.Tensor]:
+        original = tf.argmax(labels, axis=-1)
+        selected = _sample_uniform(seed, 0, _sample_keys(images)) < rate
+        flipped = tf.where(selected, tf.gather(table, original), original)
+
+        return images, tf.one_hot(flipped, num_classes, dtype=labels.dtype)
+
+    def transformation(dataset: tf.data.Dataset) -> tf.data.Dataset:
+        return dataset.map(flip, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return transformation
+
+
+def pixel_perturbation(
+    amt_of_pixels: int = 100,
+    acceptable_range: float = 0.05,
+    rate: float = 1.0,
+    seed: int = 0,
+) -> Callable[[tf.data.Dataset], tf.data.Dataset]:
+    """Return a dataset transformation that perturbs a `rate` fraction of the
+    images of a batched dataset like `DataPoisoning.poison_images`.
+
+    `amt_of_pixels` distinct off-diagonal pixels of every selected image have
+    each channel scaled by a random factor in
+    [1 - acceptable_range, 1 + acceptable_range] and truncated. Which images
+    are perturbed, and how, only depends on `seed` and the images themselves.
+    """
+    candidates = tf.constant(
+        [
+            y * img_width + x
+            for x in range(img_width)
+            for y in range(img_height)
+            if x != y
+        ],
+        dtype=tf.int32,
+    )
+
+    def perturb(images: tf.Tensor, labels: tf.Tensor) -> tuple[tf.Tensor, tf.Tensor]:
+        keys = _sample_keys(images)
+        batch_size = tf.shape(images, out_type=tf.int64)[0]
+
+        # The `amt_of_pixels` candidates with the largest random keys, as
+        # (image, pixel) indices of the whole batch.
+        chosen = tf.gather(
+            candidates,
+            tf.math.top_k(
+                _sample_uniform(seed, 0, keys, (len(candidates),)), k=amt_of_pixels
+            ).indices,
+        )
+        rows = tf.repeat(tf.range(batch_size), amt_of_pixels)
+        pixel_mask = (
+            tf.scatter_nd(
+                tf.stack([rows, tf.cast(tf.reshape(chosen, [-1]), tf.int64)], axis=1),
+                tf.ones_like(rows, dtype=tf.int32),
+                tf.stack([batch_size, img_height * img_width]),
+            )
+            > 0
+        )
+        pixel_mask = tf.reshape(pixel_mask, (-1, img_height, img_width, 1))
+
+        selected = _sample_uniform(seed, 1, keys) < rate
+        mask = tf.logical_and(pixel_mask, selected[:, None, None, None])
+
+        factors = _sample_uniform(
+            seed,
+            2,
+            keys,
+            (img_height, img_width, 3),
+            minval=1 - acceptable_range,
+            maxval=1 + acceptable_range,
+        )
+        perturbed = tf.clip_by_value(
+            tf.floor(images * tf.cast(factors, images.dtype)), 0, 255
+        )
+
+        return tf.where(mask, perturbed, images), labels
+
+    def transformation(dataset: tf.data.Dataset) -> tf.data.Dataset:
+        return dataset.map(perturb, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return transformation
+
+
+def get_poisoned_train_ds(
+    data_path: str, poisoning: str, seed: int = 0, **params: Any
+) -> tf.data.Dataset:
+    """Return the shared clean training pipeline with a per-client poisoning
+    stage appended, instead of a pre-materialized poisoned copy.
+
+    `poisoning` is "label" for `label_flip` or "data" for `pixel_perturbation`;
+    `params` are passed on to the stage.
+    """
+    stages: dict[str, Callable[..., Callable[[tf.data.Dataset], tf.data.Dataset]]]
+    stages = {"label": label_flip, "data": pixel_perturbation}
+
+    return (
+        get_train_ds(data_path, SPLITS["train"])
+        .apply(stages[poisoning](seed=seed, **params))
+        .prefetch(tf.data.AUTOTUNE)
+    )
+
+
+# In-memory arrays of evaluation splits, shared like the pipelines. Each split
+# is read under a lock of its own, so reading one does not block the others.
+_arrays: dict[tuple, tuple[np.ndarray, np.ndarray]] = {}
+_arrays_loading: dict[tuple, threading.Lock] = {}
+_arrays_lock = threading.Lock()
+
+
+def get_arrays(data_path: str, split: str) -> tuple[np.ndarray, np.ndarray]:
+    """Return the uint8 images and integer labels of a split, memory-mapped if
+    the split was converted by `convert_split` and read from its pipeline once
+    otherwise.
+
+    An unconverted split is copied into the memory of every process calling
+    this, so callers that can iterate the pipeline instead only use the arrays
+    if `has_npy_split`.
+    """
+    key = (os.path.abspath(data_path), split)
+
+    with _arrays_lock:
+        if key in _arrays:
+            return _arrays[key]
+        loading = _arrays_loading.setdefault(key, threading.Lock())
+
+    with loading:
+        with _arrays_lock:
+            if key in _arrays:
+                return _arrays[key]
+
+        if has_npy_split(data_path, split):
+            images, labels = load_npy_arrays(data_path, split)
+            labels = labels.astype(np.int64)
+        else:
+            images, labels = dataset_to_arrays(get_dataset(data_path, SPLITS[split]))
+
+        with _arrays_lock:
+            _arrays[key] = (images, labels)
+            _arrays_loading.pop(key, None)
+
+        return images, labels
+
+
+def dataset_to_arrays(dataset: tf.data.Dataset) -> tuple[np.ndarray, np.ndarray]:
+    """Materialize a batched image dataset as uint8 images and integer labels."""
+    images = []
+    labels = []
+    for image_batch, label_batch in dataset:
+        images.append(image_batch.numpy().astype(np.uint8))
+        labels.append(np.argmax(label_batch.numpy(), axis=-1))
+
+    return np.concatenate(images), np.concatenate(labels)
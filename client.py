@@ -2,9 +2,12 @@
 
 from __future__ import annotations
 
+import functools
 import os
 import platform  # type: ignore
 import sys  # type: ignore
+import threading
+from typing import TYPE_CHECKING
 
 import cpuinfo  # type: ignore
 
@@ -13,73 +16,186 @@ os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # or any {'0', '1', '2'}  # noqa: E402
 import flwr as fl  # type: ignore
 from tensorflow.keras import callbacks  # type: ignore
 
-from cinic10_ds import batch_size, get_test_val_ds, get_train_ds
-from model import create_model
+from cinic10_ds import (
+    SPLITS,
+    batch_size,
+    get_dataset,
+    get_poisoned_train_ds,
+    get_train_ds,
+)
+from codec import decode_weights, encode_weights, sparsify
+from model import ModelPool, reinitialize
+
+if TYPE_CHECKING:
+    from typing import Any, Optional
+
+    import numpy as np
+    import tensorflow as tf  # type: ignore
+
+
+@functools.lru_cache(maxsize=None)
+def get_cpu_info() -> dict[str, Any]:
+    # Probing the CPU is slow and its result never changes.
+    return cpuinfo.get_cpu_info()
 
 
 class FLClient(fl.client.NumPyClient):
-    def __init__(self, data_path: str, poisoning: str = None):
+    def __init__(
+        self,
+        data_path: str,
+        poisoning: str = None,
+        poisoning_stage: Optional[dict[str, Any]] = None,
+        seed: int = 0,
+        model_pool: Optional[ModelPool] = None,
+    ):
+        self.data_path = data_path
         self.poisoning = poisoning
 
-        if poisoning == "label":
+        if poisoning in ("label", "data") and poisoning_stage is not None:
+            # Poison the clean training set on the fly, with this client's seed.
+            self.train_ds = get_poisoned_train_ds(
+                data_path,
+                poisoning,
+                seed=poisoning_stage.get("seed", 0) + seed,
+                **poisoning_stage.get(poisoning, {}),
+            )
+        elif poisoning == "label":
             self.train_ds = get_train_ds(data_path, "train/train_label_poison")
         elif poisoning == "data":
             self.train_ds = get_train_ds(data_path, "train/train_data_poison")
         else:
             self.train_ds = get_train_ds(data_path, "train/train")
 
-        self.test_ds, self.val_ds = get_test_val_ds(data_path)
-
         self.train_count = len(self.train_ds) * batch_size
-        self.test_count = len(self.test_ds) * batch_size
-        self.val_count = len(self.val_ds) * batch_size
 
-        self.model = create_model()
+        # Simulated clients borrow a model from a shared pool for every call,
+        # others have a pool of their own single model.
+        self.model_pool = model_pool or ModelPool(1, prebuild=1)
+        # Part of the sparse updates not yet sent to the server.
+        self.residual: Optional[fl.common.Weights] = None
+        # Optimizer weights after the last fit, as pooled models do not keep
+        # this client's across rounds.
+        self.optimizer_state: Optional[list[np.ndarray]] = None
+
+        # Seconds spent per startup phase and the CPU share this client was
+        # given, filled by the runner.
+        self.startup_seconds: dict[str, float] = {}
+        self.resources: dict[str, Any] = {}
+
+    # The test and validation pipelines are shared and only built when used.
+    @property
+    def test_ds(self) -> tf.data.Dataset:
+        return get_dataset(self.data_path, SPLITS["test"])
+
+    @property
+    def val_ds(self) -> tf.data.Dataset:
+        return get_dataset(self.data_path, SPLITS["valid"])
 
     def get_properties(self, ins: fl.common.PropertiesIns) -> dict:
-        return {
-            "poisoning": str(self.poisoning),
-            "version": sys.version,
-            "platform": platform.system(),
-            "architecture": platform.machine(),
-            "processor_brand": cpuinfo.get_cpu_info()["brand_raw"],
-            "processor_version": cpuinfo.get_cpu_info()["cpuinfo_version_string"],
-            "processor_flags": ",".join(cpuinfo.get_cpu_info()["flags"]),
-            "type": "client",
-        }
+        cpu_info = get_cpu_info()
+        return (
+            {
+                "poisoning": str(self.poisoning),
+                "version": sys.version,
+                "platform": platform.system(),
+                "architecture": platform.machine(),
+                "processor_brand": cpu_info["brand_raw"],
+                "processor_version": cpu_info["cpuinfo_version_string"],
+                "processor_flags": ",".join(cpu_info["flags"]),
+                "type": "client",
+            }
+            | {
+                f"startup_{phase}_seconds": seconds
+                for phase, seconds in self.startup_seconds.items()
+            }
+            | {
+                f"resources_{key}": (
+                    ",".join(map(str, value)) if key == "cpus" else value
+                )
+                for key, value in self.resources.items()
+            }
+        )
 
     def get_parameters(self) -> fl.common.Weights:
-        return self.model.get_weights()
+        with self.model_pool.lease() as model:
+            return model.get_weights()
 
     def fit(
         self, parameters: fl.common.Parameters, config: dict
     ) -> tuple[fl.common.Weights, int, dict]:
-        self.model.set_weights(parameters)
+        # The server tells which codec, if any, its parameters are encoded with;
+        # the update is sent back with the same codec.
+        codec = config.get("codec")
+        global_weights = decode_weights(parameters, codec)
 
         callback = callbacks.EarlyStopping(monitor="loss", patience=3)
 
-        if self.poisoning == "model":
-            self.model = create_model(initializer="random_normal")
-        elif self.poisoning == "lazy":
-            pass
-        else:
-            history = self.model.fit(
-                self.train_ds,
-                epochs=config["epochs"],
-                batch_size=128,
-                validation_data=self.val_ds,
-                callbacks=[callback],
+        with self.model_pool.lease(global_weights, self.optimizer_state) as model:
+            if self.poisoning == "model":
+                reinitialize(model, "random_normal")
+                metrics = {"poisoning": self.poisoning}
+            elif self.poisoning == "lazy":
+                metrics = {"poisoning": self.poisoning}
+            else:
+                history = model.fit(
+                    self.train_ds,
+                    epochs=config["epochs"],
+                    batch_size=128,
+                    validation_data=self.val_ds,
+                    callbacks=[callback],
+                )
+                metrics = {
+                    metric: value[-1] for metric, value in history.history.items()
+                }
+                self.optimizer_state = model.optimizer.get_weights()
+
+            weights = model.get_weights()
+
+        if config.get("sparsity_ratio") is not None:
+            weights = self.sparse_update(
+                global_weights, weights, config["sparsity_ratio"]
             )
-            metrics = {metric: value[-1] for metric, value in history.history.items()}
-            return self.model.get_weights(), self.train_count, metrics
-        return self.model.get_weights(), self.train_count, {"poisoning": self.poisoning}
+            metrics["sparsity_ratio"] = config["sparsity_ratio"]
+            metrics["base_round"] = config["rnd"]
+
+        if codec is not None:
+            metrics["codec"] = codec
+
+        return (
+            encode_weights(weights, codec),
+            self.train_count,
+            metrics,
+        )
+
+    def sparse_update(
+        self,
+        global_weights: fl.common.Weights,
+        weights: fl.common.Weights,
+        ratio: float,
+    ) -> fl.common.Weights:
+        """Return the top-k entries of the update against `global_weights`.
+
+        Entries left out are kept as residual and added to the next update.
+        """
+        delta = [new - old for new, old in zip(weights, global_weights)]
+        if self.residual is not None:
+            delta = [update + rest for update, rest in zip(delta, self.residual)]
+
+        sparse, self.residual = sparsify(delta, ratio)
+        return sparse
 
     def evaluate(
         self, parameters: fl.common.Parameters, config: dict
     ) -> tuple[float, int, dict]:
-        self.model.set_weights(parameters)
-        loss, accuracy = self.model.evaluate(self.test_ds)
-        return loss, self.test_count, {"accuracy": accuracy}
+        with self.model_pool.lease(
+            decode_weights(parameters, config.get("codec"))
+        ) as model:
+            loss, accuracy = model.evaluate(self.test_ds)
+        return loss, len(self.test_ds) * batch_size, {"accuracy": accuracy}
 
     def start(self, server_address: str) -> None:
+        # The server asks for the properties right after connecting; probe the
+        # CPU while the connection is set up rather than before.
+        threading.Thread(target=get_cpu_info, daemon=True).start()
+
         fl.client.start_numpy_client(server_address + ":8080", client=self)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import math
+from typing import TYPE_CHECKING
+
+import flwr as fl  # type: ignore
+import numpy as np
+
+if TYPE_CHECKING:
+    from typing import Optional
+
+CODECS = ("float16", "int8")
+
+# Smaller tensors, such as biases and BatchNorm statistics, are sent as float32
+# by the int8 codec: their narrow ranges do not survive quantization, and they
+# are a negligible share of the bytes.
+INT8_MIN_SIZE = 1024
+
+
+def encode_weights(
+    weights: fl.common.Weights, codec: Optional[str]
+) -> fl.common.Weights:
+    """Compress the floating point tensors of `weights`.
+
+    "float16" halves every tensor. "int8" quantizes every tensor of at least
+    `INT8_MIN_SIZE` entries to int8 with a scale and zero point per output
+    channel (the last axis) of kernels and per tensor otherwise, and emits two
+    arrays per tensor: the quantized values and `[scale, zero_point]`. Other
+    tensors pass through with an empty parameter array.
+    """
+    if codec is None:
+        return weights
+
+    if codec == "float16":
+        return [
+            (
+                tensor.astype(np.float16)
+                if np.issubdtype(tensor.dtype, np.floating)
+                else tensor
+            )
+            for tensor in weights
+        ]
+
+    if codec == "int8":
+        encoded = []
+        for tensor in weights:
+            if (
+                not np.issubdtype(tensor.dtype, np.floating)
+                or tensor.size < INT8_MIN_SIZE
+            ):
+                encoded.extend([tensor, np.zeros(0, dtype=np.float64)])
+                continue
+
+            axis = tuple(range(tensor.ndim - 1)) if tensor.ndim > 1 else None
+            low = tensor.min(axis=axis).astype(np.float64)
+            high = tensor.max(axis=axis).astype(np.float64)
+            scale = (high - low) / 255
+            scale = np.where(scale > 0, scale, 1.0)
+            zero_point = np.round(-128 - low / scale)
+
+            encoded.extend(
+                [
+                    np.clip(np.round(tensor / scale + zero_point), -128, 127).astype(
+                        np.int8
+                    ),
+                    np.stack([scale, zero_point]),
+                ]
+            )
+
+        return encoded
+
+    raise ValueError(f"unknown codec {codec}")
+
+
+def decode_weights(
+    weights: fl.common.Weights, codec: Optional[str]
+) -> fl.common.Weights:
+    """Invert `encode_weights`, returning float32 tensors."""
+    if codec is None:
+        return weights
+
+    if codec == "float16":
+        return [
+            tensor.astype(np.float32) if tensor.dtype == np.float16 else tensor
+            for tensor in weights
+        ]
+
+    if codec == "int8":
+        decoded = []
+        for quantized, parameters in zip(weights[::2], weights[1::2]):
+            if parameters.size == 0:
+                decoded.append(quantized)
+                continue
+
+            # Per-channel parameters broadcast over the last axis.
+            scale, zero_point = parameters
+            decoded.append(
+                ((quantized.astype(np.float64) - zero_point) * scale).astype(np.float32)
+            )
+
+        return decoded
+
+    raise ValueError(f"unknown codec {codec}")
+
+
+def weights_nbytes(weights: fl.common.Weights) -> int:
+    return sum(tensor.nbytes for tensor in weights)
+
+
+def fit_res_to_weights(fit_res: fl.common.FitRes) -> fl.common.Weights:
+    """Return the decoded weights of a fit result, whichever codec the client
+    used."""
+    return decode_weights(
+        fl.common.parameters_to_weights(fit_res.parameters),
+        fit_res.metrics.get("codec"),
+    )
+
+
+def decode_fit_res(fit_res: fl.common.FitRes) -> fl.common.FitRes:
+    """Return a copy of an encoded fit result carrying plain float32 weights.
+
+    The encoded and decoded sizes of the weights are added to the metrics.
+    """
+    codec = fit_res.metrics.get("codec")
+    if codec is None:
+        return fit_res
+
+    encoded = fl.common.parameters_to_weights(fit_res.parameters)
+    decoded = decode_weights(encoded, codec)
+
+    metrics = {
+        name: value for name, value in fit_res.metrics.items() if name != "codec"
+    }
+    metrics["upload_bytes_encoded"] = weights_nbytes(encoded)
+    metrics["upload_bytes_decoded"] = weights_nbytes(decoded)
+
+    return fl.common.FitRes(
+        parameters=fl.common.weights_to_parameters(decoded),
+        num_examples=fit_res.num_examples,
+        metrics=metrics,
+    )
+
+
+def sparsify(
+    delta: fl.common.Weights, ratio: float
+) -> tuple[fl.common.Weights, fl.common.Weights]:
+    """Keep the `ratio` largest-magnitude entries of every tensor of `delta`.
+
+    Returns the sparse update, two arrays per tensor: the int32 flat indices
+    and the float32 values of the kept entries, and the dense residual of the
+    entries that were left out.
+    """
+    sparse = []
+    residual = []
+    for tensor in delta:
+        flat = tensor.ravel()
+        k = min(flat.size, max(1, math.ceil(ratio * flat.size)))
+
+        if k < flat.size:
+            indices = np.argpartition(np.abs(flat), flat.size - k)[flat.size - k :]
+        else:
+            indices = np.arange(flat.size)
+        indices = np.sort(indices).astype(np.int32)
+
+        rest = flat.copy()
+        rest[indices] = 0
+
+        sparse.extend([indices, flat[indices].astype(np.float32)])
+        residual.append(rest.reshape(tensor.shape))
+
+    return sparse, residual
+
+
+def densify(sparse: fl.common.Weights, base: fl.common.Weights) -> fl.common.Weights:
+    """Invert `sparsify`, adding the sparse update to the `base` weights."""
+    dense = []
+    for tensor, indices, values in zip(base, sparse[::2], sparse[1::2]):
+        updated = np.array(tensor, copy=True).ravel()
+        updated[indices] += values.astype(updated.dtype)
+        dense.append(updated.reshape(tensor.shape))
+
+    return dense
+
+
+def densify_fit_res(
+    fit_res: fl.common.FitRes, base: fl.common.Weights
+) -> fl.common.FitRes:
+    """Return a copy of a sparse, already decoded, fit result carrying the dense
+    weights `base` + update."""
+    sparse = fl.common.parameters_to_weights(fit_res.parameters)
+
+    return fl.common.FitRes(
+        parameters=fl.common.weights_to_parameters(densify(sparse, base)),
+        num_examples=fit_res.num_examples,
+        metrics=fit_res.metrics | {"upload_bytes_sparse": weights_nbytes(sparse)},
+    )
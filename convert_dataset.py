@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # noqa: E402
+
+from cinic10_ds import SPLITS, convert_split
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert CINIC-10 image folders to memory-mappable arrays"
+    )
+    parser.add_argument("--data-path", type=str, default="data/")
+    parser.add_argument(
+        "--splits", nargs="+", choices=list(SPLITS), default=list(SPLITS)
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logger = logging.getLogger("convert_dataset")
+
+    for split in args.splits:
+        if not os.path.isdir(os.path.join(args.data_path, SPLITS[split])):
+            logger.info("Skipping %s, %s not found", split, SPLITS[split])
+            continue
+
+        logger.info("Converting %s", split)
+        logger.info("Wrote %s", convert_split(args.data_path, split))
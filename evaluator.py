@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import numpy as np
+import tensorflow as tf  # type: ignore
+
+from model import create_model
+
+if TYPE_CHECKING:
+    from typing import Callable, Iterable, Iterator, Sequence, Union
+
+    import flwr as fl  # type: ignore
+    from tensorflow.keras.models import Model  # type: ignore
+
+# Thresholds of Keras' `AUC` metric with its default 200 thresholds.
+_AUC_THRESHOLDS = np.array(
+    [-1e-7] + [(index + 1) / 199 for index in range(198)] + [1 + 1e-7],
+    dtype=np.float32,
+)
+
+
+def _confusion(
+    probabilities: np.ndarray, labels: np.ndarray, thresholds: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Return true/false positives/negatives per threshold, counted like Keras'
+    thresholded metrics do over one-hot labels: every class probability is a
+    prediction, positive if above the threshold."""
+    one_hot = np.eye(probabilities.shape[1], dtype=bool)[labels]
+    positives = np.sort(probabilities[one_hot])
+    negatives = np.sort(probabilities[~one_hot])
+
+    true_positives = len(positives) - np.searchsorted(positives, thresholds, "right")
+    false_positives = len(negatives) - np.searchsorted(negatives, thresholds, "right")
+
+    return (
+        true_positives,
+        false_positives,
+        len(negatives) - false_positives,
+        len(positives) - true_positives,
+    )
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.zeros(np.shape(numerator), dtype=np.float64),
+        where=np.asarray(denominator) != 0,
+    )
+
+
+def _auc(probabilities: np.ndarray, labels: np.ndarray) -> float:
+    tp, fp, tn, fn = _confusion(probabilities, labels, _AUC_THRESHOLDS)
+    recall = _ratio(tp, tp + fn)
+    false_positive_rate = _ratio(fp, fp + tn)
+
+    return float(
+        np.sum(
+            (false_positive_rate[:-1] - false_positive_rate[1:])
+            * (recall[:-1] + recall[1:])
+            / 2
+        )
+    )
+
+
+def _at_half(
+    statistic: Callable[..., np.ndarray],
+) -> Callable[[np.ndarray, np.ndarray], float]:
+    def metric(probabilities: np.ndarray, labels: np.ndarray) -> float:
+        confusion = _confusion(probabilities, labels, np.array([0.5], dtype=np.float32))
+        return float(statistic(*confusion)[0])
+
+    return metric
+
+
+def _accuracy(probabilities: np.ndarray, labels: np.ndarray) -> float:
+    correct = np.count_nonzero(np.argmax(probabilities, axis=-1) == labels)
+    return float(np.float32(correct) / np.float32(max(len(labels), 1)))
+
+
+def _cross_entropy(probabilities: np.ndarray, labels: np.ndarray) -> float:
+    # Like Keras' categorical cross-entropy on probabilities.
+    probabilities = probabilities / probabilities.sum(axis=-1, keepdims=True)
+    picked = np.clip(probabilities[np.arange(len(labels)), labels], 1e-7, 1 - 1e-7)
+    return float(-np.log(picked.astype(np.float64)).mean())
+
+
+# The metrics of `create_model`, under the names Keras reports them, computed
+# from predicted probabilities and integer labels. "loss" leaves out the
+# regularization of the model.
+METRICS: dict[str, Callable[[np.ndarray, np.ndarray], float]] = {
+    "loss": _cross_entropy,
+    "accuracy": _accuracy,
+    "auc": _auc,
+    "recall": _at_half(lambda tp, fp, tn, fn: _ratio(tp, tp + fn)),
+    "precision": _at_half(lambda tp, fp, tn, fn: _ratio(tp, tp + fp)),
+    "true_positives": _at_half(lambda tp, fp, tn, fn: tp),
+    "false_positives": _at_half(lambda tp, fp, tn, fn: fp),
+    "true_negatives": _at_half(lambda tp, fp, tn, fn: tn),
+    "false_negatives": _at_half(lambda tp, fp, tn, fn: fn),
+}
+
+
+def compute_metrics(
+    probabilities: np.ndarray, labels: np.ndarray, names: Iterable[str]
+) -> dict[str, float]:
+    return {name: METRICS[name](probabilities, labels) for name in names}
+
+
+def predict(model: Model, images: np.ndarray, batch_size: int = 1024) -> np.ndarray:
+    """Return the predicted probabilities of `model` for uint8 `images`."""
+    return np.concatenate(
+        [
+            np.asarray(
+                model.predict_on_batch(
+                    np.asarray(images[start : start + batch_size], dtype=np.float32)
+                )
+            )
+            for start in range(0, len(images), batch_size)
+        ]
+    )
+
+
+def predict_batches(
+    model: Model, batches: Iterable[tuple[tf.Tensor, tf.Tensor]]
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the predicted probabilities of `model` and the integer labels for
+    the batches of a dataset pipeline or `ArrayBatches`."""
+    probabilities = []
+    labels = []
+    for images, one_hot_labels in batches:
+        probabilities.append(np.asarray(model.predict_on_batch(images)))
+        labels.append(np.argmax(np.asarray(one_hot_labels), axis=-1))
+
+    return np.concatenate(probabilities), np.concatenate(labels)
+
+
+class ArrayBatches:
+    """In-memory images and integer labels, iterated in batches shaped like
+    those of the dataset pipelines, which they can stand in for."""
+
+    def __init__(self, images: np.ndarray, labels: np.ndarray, batch_size: int = 1024):
+        self.images = images
+        self.labels = labels
+        self.batch_size = batch_size
+
+    def __iter__(self) -> Iterator[tuple[tf.Tensor, tf.Tensor]]:
+        for start in range(0, len(self.labels), self.batch_size):
+            yield (
+                tf.convert_to_tensor(
+                    self.images[start : start + self.batch_size], dtype=tf.float32
+                ),
+                tf.one_hot(self.labels[start : start + self.batch_size], depth=10),
+            )
+
+
+class CandidateEvaluator:
+    """Score many candidate weight sets against a single pass over a dataset.
+
+    Every candidate gets its own model instance; the instances are stacked into
+    one graph so that each validation batch is read and decoded once and then
+    fed through all candidates.
+    """
+
+    def __init__(self, max_candidates: int = 64):
+        self.max_candidates = max_candidates
+        self.models: list[Model] = []
+        self._steps: dict[int, Callable] = {}
+        # Number of samples seen by the latest `evaluate` pass.
+        self.last_sample_count = 0
+
+    def prepare(self, num_candidates: int) -> None:
+        """Build the models for `num_candidates` candidates ahead of the first
+        evaluation."""
+        self._get_step(num_candidates)
+
+    def _get_step(self, num_candidates: int) -> Callable:
+        while len(self.models) < num_candidates:
+            self.models.append(create_model())
+
+        if num_candidates not in self._steps:
+            models = self.models[:num_candidates]
+
+            @tf.function(
+                input_signature=[
+                    tf.TensorSpec(shape=(None, 32, 32, 3), dtype=tf.float32),
+                    tf.TensorSpec(shape=(None, None), dtype=tf.float32),
+                ]
+            )
+            def step(images: tf.Tensor, labels: tf.Tensor) -> tuple:
+                probabilities = tf.stack(
+                    [model(images, training=False) for model in models]
+                )
+                labels = tf.broadcast_to(labels, tf.shape(probabilities))
+
+                correct = tf.equal(
+                    tf.argmax(probabilities, axis=-1), tf.argmax(labels, axis=-1)
+                )
+                cross_entropy = tf.keras.losses.categorical_crossentropy(
+                    labels, probabilities
+                )
+
+                return correct, cross_entropy
+
+            self._steps[num_candidates] = step
+
+        return self._steps[num_candidates]
+
+    def evaluate(
+        self,
+        candidates: Sequence[fl.common.Weights],
+        dataset: Union[tf.data.Dataset, ArrayBatches],
+    ) -> list[dict[str, float]]:
+        """Return the loss and accuracy of every candidate on `dataset`.
+
+        Accuracy is accumulated exactly like Keras' `accuracy` metric, so the
+        values match what `model.evaluate` reports for the same weights.
+        """
+        metrics: list[dict[str, float]] = []
+        for start in range(0, len(candidates), self.max_candidates):
+            metrics.extend(
+                self._evaluate_chunk(
+                    candidates[start : start + self.max_candidates], dataset
+                )
+            )
+
+        return metrics
+
+    def correctness(
+        self,
+        candidates: Sequence[fl.common.Weights],
+        images: np.ndarray,
+        labels: np.ndarray,
+        batch_size: int = 256,
+    ) -> np.ndarray:
+        """Return a (candidates, samples) boolean matrix telling which samples of
+        `images` every candidate classifies correctly."""
+        if not candidates:
+            return np.zeros((0, len(labels)), dtype=bool)
+
+        correct = []
+        for start in range(0, len(candidates), self.max_candidates):
+            chunk = candidates[start : start + self.max_candidates]
+            step = self._get_step(len(chunk))
+
+            for model, weights in zip(self.models, chunk):
+                model.set_weights(weights)
+
+            correct.append(
+                np.concatenate(
+                    [
+                        step(batch_images, batch_labels)[0].numpy()
+                        for batch_images, batch_labels in ArrayBatches(
+                            images, labels, batch_size
+                        )
+                    ],
+                    axis=1,
+                )
+            )
+
+        return np.concatenate(correct)
+
+    def _evaluate_chunk(
+        self,
+        candidates: Sequence[fl.common.Weights],
+        dataset: Union[tf.data.Dataset, ArrayBatches],
+    ) -> list[dict[str, float]]:
+        step = self._get_step(len(candidates))
+
+        for model, weights in zip(self.models, candidates):
+            model.set_weights(weights)
+
+        regularization = [
+            float(tf.add_n(model.losses)) if model.losses else 0.0
+            for model in self.models[: len(candidates)]
+        ]
+
+        correct = np.zeros(len(candidates), dtype=np.int64)
+        cross_entropy = np.zeros(len(candidates), dtype=np.float64)
+        count = 0
+
+        for images, labels in dataset:
+            batch_correct, batch_cross_entropy = step(images, labels)
+            correct += batch_correct.numpy().sum(axis=1)
+            cross_entropy += batch_cross_entropy.numpy().sum(axis=1)
+            count += int(images.shape[0])
+
+        self.last_sample_count = count
+
+        return [
+            {
+                "loss": float(cross_entropy[index] / max(count, 1))
+                + regularization[index],
+                "accuracy": float(
+                    np.float32(correct[index]) / np.float32(max(count, 1))
+                ),
+            }
+            for index in range(len(candidates))
+        ]
@@ -2,13 +2,35 @@
 
 from __future__ import annotations
 
+import atexit
 import json
 import os
+import threading
 import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import IO, Optional
+
+BACKENDS = ("json", "jsonl")
 
 
 class DictLogger(object):
+    """Process-wide logger of nested dictionaries.
+
+    The "json" backend merges every logged dictionary into one document and
+    rewrites the whole file. The "jsonl" backend appends one compact record per
+    call instead, flushing and fsyncing at most every `fsync_interval` seconds;
+    `read_log` merges the records back into the same document.
+    """
+
     _json_file_name: str = ""
+    backend: str = "json"
+    fsync_interval: float = 5.0
+
+    _stream: Optional[IO[str]] = None
+    _last_sync: float = 0.0
+    _lock = threading.Lock()
 
     def __new__(cls) -> "DictLogger":
         if not cls._json_file_name:
@@ -17,10 +39,74 @@ class DictLogger(object):
 
         return super().__new__(cls)
 
+    @classmethod
+    def use_backend(cls, backend: str, fsync_interval: float = 5.0) -> None:
+        """Select the backend; must be called before the first `log`."""
+        if backend not in BACKENDS:
+            raise ValueError(f"unknown log backend {backend}")
+
+        cls()
+        cls.backend = backend
+        cls.fsync_interval = fsync_interval
+        cls._json_file_name = os.path.splitext(cls._json_file_name)[0] + "." + backend
+
     def log(self, dictionary: dict) -> None:
+        if self.backend == "jsonl":
+            self._append(dictionary)
+            return
+
         with open(self._json_file_name, "w") as f:
             self.content |= dictionary
             json.dump(self.content, f, indent=2)
 
+    def _append(self, dictionary: dict) -> None:
+        cls = type(self)
+
+        with cls._lock:
+            if cls._stream is None:
+                cls._stream = open(cls._json_file_name, "a", buffering=1 << 16)
+                atexit.register(cls.close)
+
+            cls._stream.write(json.dumps(dictionary, separators=(",", ":")) + "\n")
+
+            if time.monotonic() - cls._last_sync >= cls.fsync_interval:
+                cls._sync()
+
+    @classmethod
+    def _sync(cls) -> None:
+        if cls._stream is not None:
+            cls._stream.flush()
+            os.fsync(cls._stream.fileno())
+        cls._last_sync = time.monotonic()
+
+    @classmethod
+    def close(cls) -> None:
+        with cls._lock:
+            if cls._stream is not None:
+                cls._sync()
+                cls._stream.close()
+                cls._stream = None
+
     def delete_log_file(self) -> None:
+        self.close()
         os.remove(self._json_file_name)
+
+
+def read_log(path: str) -> dict:
+    """Return the merged dictionary of a log file written by either backend.
+
+    A truncated last record, e.g. from a crash mid-write, is ignored.
+    """
+    if not path.endswith(".jsonl"):
+        with open(path) as f:
+            return json.load(f)
+
+    content: dict = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                content |= json.loads(line)
+            except json.JSONDecodeError:
+                break
+
+    return content
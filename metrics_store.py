@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+from array import array
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Optional, Union
+
+# Column name -> array typecode. Clients and metrics are stored as indices into
+# the string tables kept in `dictionary.json`, and so are the values of string
+# metrics.
+COLUMNS = {"round": "i", "client": "i", "metric": "i", "value": "d"}
+
+REDUCERS: dict[str, Callable[[np.ndarray], float]] = {
+    "mean": np.mean,
+    "sum": np.sum,
+    "min": np.min,
+    "max": np.max,
+    "median": np.median,
+    "count": len,
+    "last": lambda values: values[-1],
+}
+
+
+class MetricsStore:
+    """Append-only store of (round, client, metric, value) rows.
+
+    Rows are buffered in typed column arrays and appended to one binary file
+    per column in `directory` whenever `flush_rows` rows are pending, or on
+    `flush`. String values are interned like client and metric names; a metric
+    holds either numbers or strings.
+    """
+
+    def __init__(self, directory: str, flush_rows: int = 4096):
+        self.directory = directory
+        self.flush_rows = flush_rows
+
+        self.clients: list[str] = []
+        self.metrics: list[str] = []
+        self.strings: list[str] = []
+        self.string_metrics: set[str] = set()
+        self._client_ids: dict[str, int] = {}
+        self._metric_ids: dict[str, int] = {}
+        self._string_ids: dict[str, int] = {}
+        self._dictionary_dirty = False
+
+        # Integer and float columns, by their typecode in `COLUMNS`.
+        self._buffers: dict[str, array[Any]] = {
+            name: array(typecode) for name, typecode in COLUMNS.items()
+        }
+        self._lock = threading.Lock()
+
+        self.last_round = 0
+
+        dictionary_path = os.path.join(directory, "dictionary.json")
+        if os.path.isfile(dictionary_path):
+            with open(dictionary_path) as f:
+                dictionary = json.load(f)
+            self.clients = dictionary["clients"]
+            self.metrics = dictionary["metrics"]
+            self.strings = dictionary.get("strings", [])
+            self.string_metrics = set(dictionary.get("string_metrics", []))
+            self._client_ids = {name: i for i, name in enumerate(self.clients)}
+            self._metric_ids = {name: i for i, name in enumerate(self.metrics)}
+            self._string_ids = {name: i for i, name in enumerate(self.strings)}
+
+            rounds = self.columns()["round"]
+            self.last_round = int(rounds.max()) if len(rounds) else 0
+
+    def _intern(self, name: str, names: list[str], ids: dict[str, int]) -> int:
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+            self._dictionary_dirty = True
+
+        return ids[name]
+
+    def append(self, rnd: int, client: str, metrics: dict[str, Any]) -> None:
+        with self._lock:
+            client_id = self._intern(client, self.clients, self._client_ids)
+
+            for name, value in metrics.items():
+                if isinstance(value, str):
+                    if name not in self.string_metrics:
+                        self.string_metrics.add(name)
+                        self._dictionary_dirty = True
+                    value = self._intern(value, self.strings, self._string_ids)
+                elif not isinstance(value, (bool, int, float, np.number)):
+                    raise TypeError(
+                        f"metric {name} has a value of unsupported type "
+                        f"{type(value).__name__}"
+                    )
+
+                self._buffers["round"].append(rnd)
+                self._buffers["client"].append(client_id)
+                self._buffers["metric"].append(
+                    self._intern(name, self.metrics, self._metric_ids)
+                )
+                self._buffers["value"].append(float(value))
+
+            self.last_round = max(self.last_round, rnd)
+
+            if len(self._buffers["round"]) >= self.flush_rows:
+                self._flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+        # The string tables go first so that every flushed row can be resolved.
+        if self._dictionary_dirty:
+            dictionary_path = os.path.join(self.directory, "dictionary.json")
+            with open(dictionary_path + ".tmp", "w") as f:
+                json.dump(
+                    {
+                        "clients": self.clients,
+                        "metrics": self.metrics,
+                        "strings": self.strings,
+                        "string_metrics": sorted(self.string_metrics),
+                    },
+                    f,
+                )
+            os.replace(dictionary_path + ".tmp", dictionary_path)
+            self._dictionary_dirty = False
+
+        for name, buffer in self._buffers.items():
+            with open(os.path.join(self.directory, name + ".bin"), "ab") as f:
+                buffer.tofile(f)
+            del buffer[:]
+
+    def columns(self) -> dict[str, np.ndarray]:
+        """Return all rows, flushed and pending, as one NumPy array per column."""
+        columns = {}
+        with self._lock:
+            for name, typecode in COLUMNS.items():
+                path = os.path.join(self.directory, name + ".bin")
+                flushed = (
+                    np.fromfile(path, dtype=np.dtype(typecode))
+                    if os.path.isfile(path)
+                    else np.zeros(0, dtype=np.dtype(typecode))
+                )
+                columns[name] = np.concatenate(
+                    [flushed, np.frombuffer(self._buffers[name], dtype=flushed.dtype)]
+                )
+
+        # A crash in the middle of a flush can leave columns of unequal length.
+        rows = min(len(column) for column in columns.values())
+        return {name: column[:rows] for name, column in columns.items()}
+
+    def query(
+        self,
+        metric: str,
+        by: str = "round",
+        reducer: str = "mean",
+        clients: Optional[list[str]] = None,
+        rounds: Optional[list[int]] = None,
+    ) -> dict[Any, Union[float, str]]:
+        """Aggregate the values of `metric` per round or per client.
+
+        `by` is "round" or "client", `reducer` one of `REDUCERS`; `clients` and
+        `rounds` restrict the rows taken into account. String metrics can only
+        be reduced with "last", which returns the string, or "count".
+        """
+        if metric not in self._metric_ids:
+            return {}
+
+        is_string = metric in self.string_metrics
+        if is_string and reducer not in ("last", "count"):
+            raise ValueError(f"cannot reduce string metric {metric} with {reducer}")
+
+        columns = self.columns()
+        mask = columns["metric"] == self._metric_ids[metric]
+        if clients is not None:
+            mask &= np.isin(
+                columns["client"],
+                [self._client_ids[c] for c in clients if c in self._client_ids],
+            )
+        if rounds is not None:
+            mask &= np.isin(columns["round"], rounds)
+
+        keys = columns[by][mask]
+        values = columns["value"][mask]
+
+        order = np.argsort(keys, kind="stable")
+        keys, values = keys[order], values[order]
+        unique_keys, starts = np.unique(keys, return_index=True)
+
+        result: dict[Any, Union[float, str]] = {
+            (self.clients[key] if by == "client" else int(key)): float(
+                REDUCERS[reducer](group)
+            )
+            for key, group in zip(unique_keys, np.split(values, starts[1:]))
+        }
+        if is_string and reducer == "last":
+            return {key: self.strings[int(value)] for key, value in result.items()}
+
+        return result
+
+    def per_round(self, metric: str, reducer: str = "mean", **kwargs: Any) -> dict:
+        return self.query(metric, by="round", reducer=reducer, **kwargs)
+
+    def per_client(self, metric: str, reducer: str = "mean", **kwargs: Any) -> dict:
+        return self.query(metric, by="client", reducer=reducer, **kwargs)
@@ -2,16 +2,45 @@
 
 from __future__ import annotations
 
+import contextlib
+import queue
+import threading
 from typing import TYPE_CHECKING
 
-from tensorflow.keras import layers, metrics, regularizers  # type: ignore
+from tensorflow.keras import (  # type: ignore
+    initializers,
+    layers,
+    metrics,
+    regularizers,
+)
 from tensorflow.keras.models import Sequential  # type: ignore
 
 if TYPE_CHECKING:
+    from typing import Iterator, Optional
+
+    import flwr as fl  # type: ignore
+    import numpy as np
     from tensorflow.keras.models import Model
 
+# Whether `create_model` compiles models with XLA unless told otherwise, set
+# by the runner.
+xla = False
+
+# Variables of the layers used by `create_model`, which all have an initializer
+# attribute of the same name plus "_initializer".
+_INITIALIZED_VARIABLES = (
+    "kernel",
+    "bias",
+    "gamma",
+    "beta",
+    "moving_mean",
+    "moving_variance",
+)
+
 
-def create_model(initializer: str = "glorot_uniform") -> Model:
+def create_model(
+    initializer: str = "glorot_uniform", jit_compile: Optional[bool] = None
+) -> Model:
     model = Sequential()
 
     model.add(
@@ -97,6 +126,7 @@ def create_model(initializer: str = "glorot_uniform") -> Model:
         )
     )
     model.compile(
+        jit_compile=xla if jit_compile is None else jit_compile,
         optimizer="adam",
         loss="categorical_crossentropy",
         metrics=[
@@ -112,3 +142,111 @@ def create_model(initializer: str = "glorot_uniform") -> Model:
     )
 
     return model
+
+
+def reinitialize(model: Model, initializer: Optional[str] = None) -> None:
+    """Draw new initial weights for `model` in place, as `create_model` would.
+
+    Kernels use `initializer` if given and every other variable the initializer
+    of its layer. Initializers are re-created for each draw, as Keras returns
+    the same values from an unseeded initializer called twice.
+    """
+    for layer in model.layers:
+        for name in _INITIALIZED_VARIABLES:
+            variable = getattr(layer, name, None)
+            if variable is None:
+                continue
+
+            initializer_config = initializers.serialize(
+                initializers.get(
+                    initializer
+                    if name == "kernel" and initializer is not None
+                    else getattr(layer, f"{name}_initializer")
+                )
+            )
+            variable.assign(
+                initializers.deserialize(initializer_config)(
+                    variable.shape, variable.dtype
+                )
+            )
+
+
+class ModelPool:
+    """Thread-safe pool of up to `size` models built by `create_model`.
+
+    Models are built on first demand, or `prebuild` of them right away, and
+    handed out by `lease`, which blocks while all of them are in use. A leased
+    model keeps the weights of its previous user unless `lease` is given the
+    weights to load. Its optimizer is always reset, or set to the state
+    given to `lease`, so no optimizer state passes from one user to the next.
+    """
+
+    def __init__(
+        self, size: int, initializer: str = "glorot_uniform", prebuild: int = 0
+    ):
+        self.size = size
+        self.initializer = initializer
+
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._built = 0
+        self._lock = threading.Lock()
+        # Optimizer weights of a newly built model, to reset leased models to.
+        self._initial_optimizer_state: Optional[list[np.ndarray]] = None
+
+        for _ in range(min(prebuild, size)):
+            self._built += 1
+            self._idle.put(self._build())
+
+    def _build(self) -> Model:
+        model = create_model(initializer=self.initializer)
+
+        # Keras creates the optimizer's slots on the first training step; create
+        # them now, as Keras does itself to load a saved optimizer, so that
+        # optimizer states can be loaded into any pooled model.
+        model.optimizer._create_all_weights(model.trainable_variables)
+        if self._initial_optimizer_state is None:
+            self._initial_optimizer_state = model.optimizer.get_weights()
+
+        return model
+
+    def acquire(self) -> Model:
+        with self._lock:
+            build = self._idle.empty() and self._built < self.size
+            if build:
+                self._built += 1
+
+        if build:
+            return self._build()
+
+        return self._idle.get()
+
+    def release(self, model: Model) -> None:
+        self._idle.put(model)
+
+    @contextlib.contextmanager
+    def lease(
+        self,
+        weights: Optional[fl.common.Weights] = None,
+        optimizer_state: Optional[list[np.ndarray]] = None,
+    ) -> Iterator[Model]:
+        """Lend a model, loaded with `weights` and with the optimizer weights
+        `optimizer_state` of an earlier lease, or a reset optimizer."""
+        model = self.acquire()
+        try:
+            if weights is not None:
+                model.set_weights(weights)
+            model.optimizer.set_weights(
+                optimizer_state
+                if optimizer_state is not None
+                else self._initial_optimizer_state
+            )
+            yield model
+        finally:
+            self.release(model)
+
+    def initial_weights(self, initializer: Optional[str] = None) -> fl.common.Weights:
+        """Return new initial weights, drawn on a pooled model instead of a newly
+        built one."""
+        with self.lease() as model:
+            reinitialize(model, initializer or self.initializer)
+            return model.get_weights()
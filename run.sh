@@ -4,6 +4,19 @@ set -euo pipefail
 
 docker_image='nkakouros/flwr-run:model'
 
+# Wait until the server process $1 accepts connections on port $2.
+wait_for_server() {
+    local pid="$1" port="$2"
+
+    until (exec 3<>"/dev/tcp/localhost/$port") 2>/dev/null; do
+        if ! kill -0 "$pid" 2>/dev/null; then
+            echo "Server exited before listening" >&2
+            exit 1
+        fi
+        sleep 0.2
+    done
+}
+
 run_local() {
     if [[ ! -d data ]]; then
         echo Downloading image set
@@ -15,12 +28,12 @@ run_local() {
 
     echo "Starting server"
     python3 runner.py --server --config configs/config.local.yml &
-    sleep 5  # Sleep for 3s to give the server enough time to start
+    wait_for_server $! 8080
 
     echo "Starting client 1"
-    python3 runner.py --client --poisoned --config configs/config.local.yml &
+    python3 runner.py --client --poisoned --seed 1 --config configs/config.local.yml &
     echo "Starting client 2"
-    python3 runner.py --client --poisoned --config configs/config.local.yml &
+    python3 runner.py --client --poisoned --seed 2 --config configs/config.local.yml &
 
     # This will allow you to use CTRL+C to stop all background processes
     trap "trap - SIGTERM && kill -- -$$" SIGINT SIGTERM
@@ -4,6 +4,9 @@ from __future__ import annotations
 
 import argparse
 import os
+import time
+
+startup = time.perf_counter()
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # noqa: E402
 # silence tensorflow warnings, needs to run before importing flower
@@ -15,9 +18,11 @@ import yaml  # type: ignore
 if TYPE_CHECKING:
     from typing import Any
 
-from client import FLClient
 from logger import DictLogger
-from server import FLServer
+from tracing import tracer
+
+# TensorFlow, Flower and the role modules are imported by the role that needs
+# them, as they make up most of the startup time.
 
 
 def get_server_and_client_info(config: dict[str, Any]) -> tuple:
@@ -88,12 +93,130 @@ def get_server_and_client_info(config):
     return server, clients, num_fl_clients, num_poisoned_clients
 
 
+def get_poisoned_containers(
+    config: dict[str, Any], clients: list[Any], num_clients: int
+) -> list[bool]:
+    """Return for each of `num_clients` simulated clients whether it is
+    poisoned, repeating the containers of the client machines as needed."""
+    poisoned = []
+    for client in clients:
+        if isinstance(client, str):
+            poisoned.extend([False] * config["containers_per_machine"])
+        else:
+            poisoned.extend(
+                index in client.get("poisoned_containers", [])
+                for index in range(
+                    client.get("num_containers", config["containers_per_machine"])
+                )
+            )
+
+    if not poisoned:
+        return [False] * num_clients
+
+    return [poisoned[index % len(poisoned)] for index in range(num_clients)]
+
+
+def get_machine(clients: list[Any], name: str) -> Any:
+    """Return the client machine entry named `name` by its address or name."""
+    for client in clients:
+        if client == name or (
+            isinstance(client, dict)
+            and name in (client.get("address"), client.get("name"))
+        ):
+            return client
+
+    raise ValueError(f"no client machine {name} in the config")
+
+
+def plan_resources(
+    config: dict[str, Any], machine: Any, container_index: int
+) -> dict[str, Any]:
+    """Split the CPUs of `machine` evenly between its containers.
+
+    Container `container_index` gets a contiguous share of the cores, as many
+    intra-op threads as cores in its share and, by default, one inter-op
+    thread. Cores are reused round-robin if there are more containers than
+    cores. The `resources` config section sets the number of cores per machine,
+    unless the machine entry has its own `cpus`, the inter-op threads, pinning
+    and XLA.
+
+    The cores are only split if the process sees all of the machine's cores. A
+    process already limited to fewer, e.g. by `docker run --cpuset-cpus`, takes
+    the cores it sees as its share.
+    """
+    resources = config.get("resources", {})
+    if not isinstance(machine, dict):
+        machine = {}
+
+    available = sorted(os.sched_getaffinity(0))
+    if len(available) < (os.cpu_count() or len(available)):
+        cores = available
+        containers = 1
+        container_index = 0
+    else:
+        cores = available[: machine.get("cpus", resources.get("cpus", len(available)))]
+        containers = machine.get("num_containers", config["containers_per_machine"])
+
+    share = max(1, len(cores) // containers)
+    first = container_index * share
+    return {
+        "cpus": [cores[(first + index) % len(cores)] for index in range(share)],
+        "intra_op_threads": share,
+        "inter_op_threads": min(resources.get("inter_op_threads", 1), share),
+        "pin": resources.get("pin", True),
+        "jit_compile": resources.get("jit_compile", False),
+    }
+
+
+def apply_resources(plan: dict[str, Any]) -> None:
+    """Apply a plan of `plan_resources`; it has to run before TensorFlow runs
+    any op, as its thread pools are only sized once."""
+    os.environ["OMP_NUM_THREADS"] = str(plan["intra_op_threads"])
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(plan["intra_op_threads"])
+    os.environ["TF_NUM_INTEROP_THREADS"] = str(plan["inter_op_threads"])
+    if plan["pin"]:
+        os.sched_setaffinity(0, plan["cpus"])
+
+    import tensorflow as tf  # type: ignore
+
+    import model
+
+    tf.config.threading.set_intra_op_parallelism_threads(plan["intra_op_threads"])
+    tf.config.threading.set_inter_op_parallelism_threads(plan["inter_op_threads"])
+    model.xla = plan["jit_compile"]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Flower")
     parser.add_argument("--config", type=str, required=True)
     parser.add_argument("--server", action="store_true")
     parser.add_argument("--client", action="store_true")
     parser.add_argument("--poisoned", action="store_true")
+    parser.add_argument(
+        "--seed", type=int, default=0, help="per-client offset of the poisoning seed"
+    )
+    parser.add_argument(
+        "--simulate",
+        type=int,
+        metavar="N",
+        help="run the server against N in-process clients instead of over gRPC",
+    )
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const="",
+        metavar="CHECKPOINT",
+        help="continue the server from a checkpoint, by default the latest one",
+    )
+    parser.add_argument(
+        "--machine",
+        help="address or name of the client machine this container runs on",
+    )
+    parser.add_argument(
+        "--container-index",
+        type=int,
+        help="index of this container on its machine, to plan its CPU share",
+    )
     args = parser.parse_args()
 
     config_file = args.config
@@ -105,29 +228,110 @@ if __name__ == "__main__":
     else:
         raise FileNotFoundError(f"config file {config_file} not found")
 
+    if args.resume == "" and "directory" not in (config.get("checkpoint") or {}):
+        parser.error("--resume needs a checkpoint directory in the config")
+
     server, clients, num_fl_clients, num_poisoned_clients = get_server_and_client_info(
         config
     )
 
-    if args.server:
+    DictLogger.use_backend(config.get("log_backend", "json"))
+    if config.get("tracing", False):
+        tracer.enable()
+
+    startup_seconds = {"config": time.perf_counter() - startup}
+
+    if args.server or args.simulate:
+        phase_start = time.perf_counter()
+        import cinic10_ds
+        from checkpoint import latest_checkpoint
+        from server import FLServer
+
+        cinic10_ds.cache = config.get("dataset_cache")
+        startup_seconds["imports"] = time.perf_counter() - phase_start
+
         try:
             l = DictLogger()  # noqa: E741
             l.log({"config": config})
 
-            FLServer(
+            phase_start = time.perf_counter()
+            resume = args.resume
+            if resume == "":
+                resume = latest_checkpoint(config["checkpoint"]["directory"])
+                if resume is None:
+                    raise FileNotFoundError("no checkpoint to resume from")
+
+            fl_server = FLServer(
                 config["data_path"],
-                num_fl_clients,
+                args.simulate or num_fl_clients,
                 config["poisoned_client_selection"],
                 config["fraction_fit"],
                 config["model"]["rounds"],
                 config["model"]["epochs"],
-            ).start()
+                validation=config.get("validation"),
+                codec=config.get("codec"),
+                sparsity_ratio=config.get("sparsity_ratio"),
+                streaming_aggregation=config.get("streaming_aggregation", False),
+                round_policy=config.get("round_policy"),
+                defense=config.get("defense"),
+                prefilter=config.get("prefilter"),
+                checkpoint=config.get("checkpoint"),
+                resume=resume,
+                evaluation=config.get("evaluation"),
+            )
+            startup_seconds["init"] = time.perf_counter() - phase_start
+            fl_server.startup_seconds |= startup_seconds
+
+            if args.simulate:
+                from simulation import simulate
+
+                simulate(
+                    fl_server,
+                    [
+                        {
+                            "data_path": config["data_path"],
+                            "poisoning": poisoned and config["poisoning"] or None,
+                            "poisoning_stage": config.get("poisoning_stage"),
+                            "seed": index,
+                        }
+                        for index, poisoned in enumerate(
+                            get_poisoned_containers(config, clients, args.simulate)
+                        )
+                    ],
+                    **config.get("simulation", {}),
+                )
+            else:
+                fl_server.start()
         except Exception as e:
             l.delete_log_file()
             raise (e)
 
     else:
-        FLClient(
+        phase_start = time.perf_counter()
+        resources = None
+        if args.container_index is not None:
+            resources = plan_resources(
+                config,
+                get_machine(clients, args.machine) if args.machine else None,
+                args.container_index,
+            )
+            apply_resources(resources)
+
+        import cinic10_ds
+        from client import FLClient
+
+        cinic10_ds.cache = config.get("dataset_cache")
+        startup_seconds["imports"] = time.perf_counter() - phase_start
+
+        phase_start = time.perf_counter()
+        fl_client = FLClient(
             config["data_path"],
             poisoning=args.poisoned and config["poisoning"] or None,
-        ).start(server["address"])
+            poisoning_stage=config.get("poisoning_stage"),
+            seed=args.seed,
+        )
+        startup_seconds["init"] = time.perf_counter() - phase_start
+        fl_client.startup_seconds |= startup_seconds
+        fl_client.resources = resources or {}
+
+        fl_client.start(server["address"])
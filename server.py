@@ -2,18 +2,34 @@
 
 from __future__ import annotations
 
+import concurrent.futures
 import math
+import os
 import platform
 import sys
+import threading
+import time
 from typing import TYPE_CHECKING
 
-import cpuinfo  # type: ignore  # missing stub
 import flwr as fl  # type: ignore
-from pip._internal.operations import freeze as pip_freeze
+import numpy as np
 
-from cinic10_ds import get_test_val_ds
+from aggregation import (
+    RunningWeightedAverage,
+    flatten,
+    geometric_prefilter,
+    robust_aggregate,
+    stack_updates,
+    unflatten,
+)
+from checkpoint import Checkpointer, load_state, pack_state
+from cinic10_ds import SPLITS, get_arrays, get_dataset, has_npy_split
+from codec import decode_fit_res, densify_fit_res, encode_weights, weights_nbytes
+from evaluator import METRICS, compute_metrics, predict, predict_batches
 from logger import DictLogger
+from metrics_store import MetricsStore
 from model import create_model
+from tracing import span, tracer
 from validation_server import ValidationServer
 
 if TYPE_CHECKING:
@@ -25,35 +41,90 @@ if TYPE_CHECKING:
 l = DictLogger()  # noqa: E741
 
 get_properties_ins = fl.common.PropertiesIns({})
-all_metrics: dict[int, dict] = {}
+# Per-round metrics of the clients and the server, kept next to the log file.
+metrics_store = MetricsStore(os.path.splitext(l._json_file_name)[0] + ".metrics")
+
+
+def log_checkpoint(rnd: int, seconds: float, nbytes: int) -> None:
+    metrics_store.append(
+        rnd, "server", {"checkpoint_seconds": seconds, "checkpoint_bytes": nbytes}
+    )
+
+
+class PropertiesClientManager(fl.server.client_manager.SimpleClientManager):
+    """Client manager that caches the properties of every client.
+
+    Properties are requested once, right after a client registers, and dropped
+    when it unregisters, so a reconnecting client is asked again.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._properties_fetched: dict[str, threading.Event] = {}
+
+    def register(self, client: fl.server.client_proxy.ClientProxy) -> bool:
+        if not super().register(client):
+            return False
+
+        # The client's message stream only starts being served once `register`
+        # returns, so the request has to be made from another thread.
+        fetched = threading.Event()
+        self._properties_fetched[client.cid] = fetched
+        threading.Thread(
+            target=self._fetch_properties, args=(client, fetched), daemon=True
+        ).start()
+
+        return True
+
+    def unregister(self, client: fl.server.client_proxy.ClientProxy) -> None:
+        super().unregister(client)
+        self._properties_fetched.pop(client.cid, None)
+
+    def _fetch_properties(
+        self, client: fl.server.client_proxy.ClientProxy, fetched: threading.Event
+    ) -> None:
+        try:
+            client.properties = client.get_properties(
+                get_properties_ins, None
+            ).properties
+        finally:
+            fetched.set()
+
+    def get_client_properties(
+        self, client: fl.server.client_proxy.ClientProxy
+    ) -> dict[str, Any]:
+        fetched = self._properties_fetched.get(client.cid)
+        if fetched is not None:
+            fetched.wait()
+
+        if not client.properties:
+            client.properties = client.get_properties(
+                get_properties_ins, None
+            ).properties
+
+        return client.properties
 
 
 class SelectClientsCritertion(fl.server.criterion.Criterion):
-    def __init__(self, poisoned: bool):
+    def __init__(self, poisoned: bool, client_manager: PropertiesClientManager):
         self.poisoned = poisoned
+        self.client_manager = client_manager
 
     def select(self, client: fl.server.client_proxy.ClientProxy) -> bool:
+        properties = self.client_manager.get_client_properties(client)
+
         if self.poisoned:
-            return (
-                client.get_properties(get_properties_ins, None).properties["poisoning"]
-                != "None"
-            )
+            return properties["poisoning"] != "None"
         else:
-            return (
-                client.get_properties(get_properties_ins, None).properties["poisoning"]
-                == "None"
-            )
-
-
-get_properties_ins = fl.common.PropertiesIns({})
+            return properties["poisoning"] == "None"
 
 
 class SelectNonPoisonedClientsCritertion(fl.server.criterion.Criterion):
+    def __init__(self, client_manager: PropertiesClientManager):
+        self.client_manager = client_manager
+
     def select(self, client: fl.server.client_proxy.ClientProxy) -> bool:
-        return (
-            client.get_properties(get_properties_ins, None).properties["poisoning"]
-            == "None"
-        )
+        return self.client_manager.get_client_properties(client)["poisoning"] == "None"
 
 
 class SaveModelStrategy(fl.server.strategy.FedAvg):
@@ -63,38 +134,136 @@ class SaveModelStrategy(fl.server.strategy.FedAvg):
         data_path: str,
         num_fl_clients: int,
         poisoned_client_selection: Union[str, float],
+        validation: Optional[dict[str, Any]] = None,
+        codec: Optional[str] = None,
+        sparsity_ratio: Optional[float] = None,
+        streaming: bool = False,
+        round_policy: Optional[dict[str, Any]] = None,
+        defense: Optional[dict[str, Any]] = None,
+        prefilter: Optional[dict[str, Any]] = None,
         **kwargs: Any,
     ):
+        if defense is not None and streaming:
+            raise ValueError("robust aggregation needs all updates of a round")
+        if prefilter is not None and streaming:
+            raise ValueError("the pre-filter needs all updates of a round")
+
         self.total_fl_clients_in_inventory = num_fl_clients
+        self.codec = codec
+        self.sparsity_ratio = sparsity_ratio
+        self.streaming = streaming
+        self.round_policy = round_policy
+        # A robust aggregation rule replaces FedAvg and the validation vote.
+        self.defense = defense
+        self.global_weights: Optional[fl.common.Weights] = None
+        # Cheap geometric checks that settle clear cases before validation.
+        self.prefilter = prefilter
+        self.validation_seconds_per_client: Optional[float] = None
+        # With a round policy, fits can outlive their round. Clients with a fit
+        # in flight are not selected again; the value is the round it was for.
+        self.dispatched: dict[str, int] = {}
+        # Global weights sent out per round, which sparse updates are relative to.
+        self.round_weights: dict[int, fl.common.Weights] = {}
         self.poisoned_client_selection = poisoned_client_selection
         self.blacklist: set[str] = set()
+        # Global weights to start from instead of the initial ones, on resume.
+        self.resume_parameters: Optional[fl.common.Parameters] = None
 
         super().__init__(*args, **kwargs)
 
-        self.criterion = SelectNonPoisonedClientsCritertion()
-
-        self.validator = ValidationServer(
-            num_of_models=3,
-            data_path=data_path,
-        )
+        self.validator: Optional[ValidationServer] = None
+        if defense is None:
+            self.validator = ValidationServer(
+                data_path=data_path,
+                **{"num_of_models": 3, **(validation or {})},
+            )
 
         self.blacklisted_clients: list[int] = []
 
     def initialize_parameters(
         self, client_manager: fl.server.client_manager.ClientManager
-    ) -> None:
+    ) -> Optional[fl.common.Parameters]:
         """Wait for all configured clients to come up online and connect to server."""
+        self.client_manager = client_manager
+        self.criterion = SelectNonPoisonedClientsCritertion(client_manager)
+
         client_manager.wait_for(self.total_fl_clients_in_inventory)
 
+        return self.resume_parameters
+
     def aggregate_fit(
         self,
         rnd: int,
         results: list[tuple[fl.server.client_proxy.ClientProxy, fl.common.FitRes]],
         failures: list[BaseException],
-    ) -> Optional[fl.common.Weights]:
+    ) -> tuple[Optional[fl.common.Parameters], dict]:
         self.round = rnd
 
-        self.update_blacklist(results)
+        if self.round_policy is not None:
+            results = [
+                (client_proxy, self.weight_by_staleness(rnd, client_proxy, fit_res))
+                for client_proxy, fit_res in results
+            ]
+
+        upload_bytes = sum(
+            len(tensor)
+            for _, fit_res in results
+            for tensor in fit_res.parameters.tensors
+        )
+
+        if self.streaming:
+            aggregated_parameters, aggregated_metrics, aggregation_seconds = (
+                self.aggregate_fit_streaming(rnd, results, failures)
+            )
+        else:
+            aggregated_parameters, aggregated_metrics, aggregation_seconds = (
+                self.aggregate_fit_batch(rnd, results, failures)
+            )
+        # Sparse updates of fits still in flight need the weights of their round.
+        oldest_needed = min(self.dispatched.values(), default=rnd + 1)
+        self.round_weights = {
+            weights_round: weights
+            for weights_round, weights in self.round_weights.items()
+            if weights_round >= oldest_needed
+        }
+
+        metrics_store.append(
+            rnd,
+            "server",
+            {"upload_bytes": upload_bytes, "aggregation_seconds": aggregation_seconds},
+        )
+
+        # No update may have made it in time.
+        if aggregated_parameters is not None and self.validator is not None:
+            with span("validator.update"):
+                self.validator.update(
+                    fl.common.parameters_to_weights(aggregated_parameters), rnd
+                )
+
+        return aggregated_parameters, aggregated_metrics
+
+    def aggregate_fit_batch(
+        self,
+        rnd: int,
+        results: list[tuple[fl.server.client_proxy.ClientProxy, fl.common.FitRes]],
+        failures: list[BaseException],
+    ) -> tuple[Optional[fl.common.Parameters], dict, float]:
+        if self.defense is not None:
+            return self.aggregate_fit_robust(rnd, results, failures)
+
+        # Everything below works on plain, dense float32 weights.
+        with span("decode_updates"):
+            results = [
+                (client_proxy, self.decode_update(fit_res))
+                for client_proxy, fit_res in results
+            ]
+
+        validation_start = time.perf_counter()
+        with span("validate_clients", clients=len(results)):
+            validation_results = self.update_blacklist(results)
+        self.log_detection(
+            rnd, results, validation_results, time.perf_counter() - validation_start
+        )
 
         valid_results = [
             (client_proxy, fit_result)
@@ -102,32 +271,315 @@ class SaveModelStrategy(fl.server.strategy.FedAvg):
             if client_proxy.cid not in self.blacklist
         ]
 
-        all_metrics[rnd] = {}
-        for result in results:
-            all_metrics[rnd]["client://" + str(result[0].cid)] = result[1].metrics
-            all_metrics[rnd]["client://" + str(result[0].cid)]["num_examples"] = result[
-                1
-            ].num_examples
+        for client_proxy, fit_res in results:
+            self.log_client_metrics(rnd, client_proxy, fit_res)
+
+        aggregation_start = time.perf_counter()
+        with span("fedavg", clients=len(valid_results)):
+            aggregated_parameters, aggregated_metrics = super().aggregate_fit(
+                rnd, valid_results, failures
+            )
+
+        return (
+            aggregated_parameters,
+            aggregated_metrics,
+            time.perf_counter() - aggregation_start,
+        )
+
+    def aggregate_fit_streaming(
+        self,
+        rnd: int,
+        results: list[tuple[fl.server.client_proxy.ClientProxy, fl.common.FitRes]],
+        failures: list[BaseException],
+    ) -> tuple[Optional[fl.common.Parameters], dict, float]:
+        """Decode, validate and fold in one client update at a time, so that at
+        most one decoded update is held besides the running sum."""
+        # Streaming rules out a defense, so there always is a validator.
+        validator = self.validator
+        if validator is None:
+            raise ValueError("streaming aggregation needs the validation vote")
+
+        if not results or (not self.accept_failures and failures):
+            return None, {}, 0.0
+
+        validator.decision_stats = {}
+        average = RunningWeightedAverage()
+        aggregation_seconds = 0.0
+        validation_results = {}
+        validation_seconds = 0.0
+
+        for client_proxy, fit_res in results:
+            with span("decode_update", cid=client_proxy.cid):
+                fit_res = self.decode_update(fit_res)
+                weights = fl.common.parameters_to_weights(fit_res.parameters)
+
+            validation_start = time.perf_counter()
+            with span("validate_client", cid=client_proxy.cid):
+                validation_results[client_proxy.cid] = validator.validate_client(
+                    client_proxy.cid, weights
+                )
+            validation_seconds += time.perf_counter() - validation_start
+            if validation_results[client_proxy.cid] is True:
+                self.blacklist.add(client_proxy.cid)
+
+            self.log_client_metrics(rnd, client_proxy, fit_res)
+
+            if client_proxy.cid not in self.blacklist:
+                aggregation_start = time.perf_counter()
+                with span("fold_update", cid=client_proxy.cid):
+                    average.add(weights, fit_res.num_examples)
+                aggregation_seconds += time.perf_counter() - aggregation_start
+
+            del fit_res, weights
+
+        self.log_detection(rnd, results, validation_results, validation_seconds)
+
+        if average.count == 0:
+            return None, {}, aggregation_seconds
+
+        return (
+            fl.common.weights_to_parameters(average.result()),
+            {},
+            aggregation_seconds,
+        )
+
+    def aggregate_fit_robust(
+        self,
+        rnd: int,
+        results: list[tuple[fl.server.client_proxy.ClientProxy, fl.common.FitRes]],
+        failures: list[BaseException],
+    ) -> tuple[Optional[fl.common.Parameters], dict, float]:
+        """Aggregate the updates with the configured robust rule instead of
+        FedAvg and the validation vote."""
+        defense = self.defense
+        global_weights = self.global_weights
+        if defense is None or global_weights is None:
+            raise ValueError("robust aggregation needs a defense and global weights")
+
+        if not results or (not self.accept_failures and failures):
+            return None, {}, 0.0
 
-        aggregated_parameters, aggregated_metrics = super().aggregate_fit(
-            rnd, valid_results, failures
+        aggregation_start = time.perf_counter()
+
+        fit_results = [self.decode_update(fit_res) for _, fit_res in results]
+        updates = stack_updates(
+            (
+                fl.common.parameters_to_weights(fit_res.parameters)
+                for fit_res in fit_results
+            ),
+            global_weights,
+            len(fit_results),
         )
+        with span("robust_aggregate", method=defense["method"]):
+            aggregate, flagged = robust_aggregate(
+                updates,
+                np.array([fit_res.num_examples for fit_res in fit_results]),
+                **defense,
+            )
+        del updates
 
-        self.validator.update(
-            fl.common.parameters_to_weights(aggregated_parameters), rnd
+        weights = unflatten(aggregate + flatten(global_weights), global_weights)
+        aggregation_seconds = time.perf_counter() - aggregation_start
+
+        self.log_detection(
+            rnd,
+            results,
+            {
+                client_proxy.cid: bool(client_flagged)
+                for (client_proxy, _), client_flagged in zip(results, flagged)
+            },
+            aggregation_seconds,
         )
+        for (client_proxy, _), fit_res, client_flagged in zip(
+            results, fit_results, flagged
+        ):
+            self.log_client_metrics(
+                rnd, client_proxy, fit_res, {"flagged": bool(client_flagged)}
+            )
 
-        return aggregated_parameters, aggregated_metrics
+        return fl.common.weights_to_parameters(weights), {}, aggregation_seconds
+
+    def log_client_metrics(
+        self,
+        rnd: int,
+        client_proxy: fl.server.client_proxy.ClientProxy,
+        fit_res: fl.common.FitRes,
+        extra: Optional[dict[str, Any]] = None,
+    ) -> None:
+        decision_stats = {}
+        if self.validator is not None:
+            decision_stats = self.validator.decision_stats.get(client_proxy.cid, {})
+
+        metrics_store.append(
+            rnd,
+            "client://" + str(client_proxy.cid),
+            fit_res.metrics
+            | {"num_examples": fit_res.num_examples}
+            | {"validation_" + name: value for name, value in decision_stats.items()}
+            | (extra or {}),
+        )
+
+    def log_detection(
+        self,
+        rnd: int,
+        results: list[tuple[fl.server.client_proxy.ClientProxy, fl.common.FitRes]],
+        flagged: dict[str, bool],
+        seconds: float,
+    ) -> None:
+        """Record how well the defense's flags match the clients' actual
+        poisoning, and what the defense cost."""
+        poisoned = {
+            client_proxy.cid: self.client_manager.get_client_properties(client_proxy)[
+                "poisoning"
+            ]
+            != "None"
+            for client_proxy, _ in results
+        }
+
+        true_positives = sum(flagged[cid] and poisoned[cid] for cid in poisoned)
+        false_positives = sum(flagged[cid] and not poisoned[cid] for cid in poisoned)
+        false_negatives = sum(not flagged[cid] and poisoned[cid] for cid in poisoned)
+
+        detection = {
+            "defense_seconds": seconds,
+            "detection_true_positives": true_positives,
+            "detection_false_positives": false_positives,
+            "detection_false_negatives": false_negatives,
+        }
+        if true_positives + false_positives:
+            detection["detection_precision"] = true_positives / (
+                true_positives + false_positives
+            )
+        if true_positives + false_negatives:
+            detection["detection_recall"] = true_positives / (
+                true_positives + false_negatives
+            )
+
+        metrics_store.append(rnd, "server", detection)
+
+    def weight_by_staleness(
+        self,
+        rnd: int,
+        client_proxy: fl.server.client_proxy.ClientProxy,
+        fit_res: fl.common.FitRes,
+    ) -> fl.common.FitRes:
+        """Release the client and, for buffered asynchronous rounds, scale the
+        weight of an update from an earlier round by (1 + staleness)^-a."""
+        staleness = rnd - self.dispatched.pop(client_proxy.cid, rnd)
+        round_policy = self.round_policy
+        if round_policy is None or round_policy.get("mode") != "async":
+            return fit_res
+
+        return fl.common.FitRes(
+            parameters=fit_res.parameters,
+            num_examples=fit_res.num_examples
+            * (1 + staleness) ** -round_policy.get("staleness_exponent", 0.5),
+            metrics=fit_res.metrics | {"staleness": staleness},
+        )
+
+    def decode_update(self, fit_res: fl.common.FitRes) -> fl.common.FitRes:
+        fit_res = decode_fit_res(fit_res)
+
+        if "sparsity_ratio" in fit_res.metrics:
+            fit_res = densify_fit_res(
+                fit_res, self.round_weights[fit_res.metrics["base_round"]]
+            )
+
+        return fit_res
 
     def update_blacklist(
         self, results: list[tuple[fl.server.client_proxy.ClientProxy, fl.common.FitRes]]
-    ) -> None:
-        validation_results = self.validator.validate_clients(results)
+    ) -> dict[str, bool]:
+        # Without a defense, clients are always validated.
+        validator = self.validator
+        if validator is None:
+            raise ValueError("the validation vote needs a validator")
+
+        validation_results = {}
+        if self.prefilter is not None:
+            prefilter_start = time.perf_counter()
+            with span("prefilter", clients=len(results)):
+                validation_results = self.prefilter_clients(results)
+            prefilter_seconds = time.perf_counter() - prefilter_start
+
+            results = [
+                (client_proxy, fit_res)
+                for client_proxy, fit_res in results
+                if client_proxy.cid not in validation_results
+            ]
+
+        validation_start = time.perf_counter()
+        if results:
+            validation_results |= validator.validate_clients(results)
+        else:
+            validator.decision_stats = {}
+        validation_seconds = time.perf_counter() - validation_start
+
+        if self.prefilter is not None:
+            if results:
+                self.validation_seconds_per_client = validation_seconds / len(results)
+
+            decided = len(validation_results) - len(results)
+            metrics_store.append(
+                self.round,
+                "server",
+                {
+                    "prefilter_seconds": prefilter_seconds,
+                    "prefilter_decided_fraction": (
+                        decided / len(validation_results) if validation_results else 0.0
+                    ),
+                    "prefilter_saved_seconds": decided
+                    * (self.validation_seconds_per_client or 0.0),
+                },
+            )
 
         self.blacklist |= {
             cid for cid, value in validation_results.items() if value is True
         }
 
+        return validation_results
+
+    def prefilter_clients(
+        self, results: list[tuple[fl.server.client_proxy.ClientProxy, fl.common.FitRes]]
+    ) -> dict[str, bool]:
+        """Return the validation verdict of the clients the geometric pre-filter
+        could decide on its own; True means the client is rejected."""
+        prefilter = self.prefilter
+        global_weights = self.global_weights
+        if not results or prefilter is None or global_weights is None:
+            return {}
+
+        updates = stack_updates(
+            (
+                fl.common.parameters_to_weights(fit_res.parameters)
+                for _, fit_res in results
+            ),
+            global_weights,
+            len(results),
+        )
+        rejected, accepted, features = geometric_prefilter(
+            updates, flatten(global_weights), **prefilter
+        )
+        del updates
+
+        decisions = {}
+        for index, (client_proxy, _) in enumerate(results):
+            metrics_store.append(
+                self.round,
+                "client://" + str(client_proxy.cid),
+                {
+                    "prefilter_" + name: values[index]
+                    for name, values in features.items()
+                },
+            )
+
+            if rejected[index]:
+                decisions[client_proxy.cid] = True
+            elif accepted[index]:
+                decisions[client_proxy.cid] = False
+
+        return decisions
+
     def configure_fit(
         self,
         rnd: int,
@@ -139,6 +591,29 @@ class SaveModelStrategy(fl.server.strategy.FedAvg):
         if self.on_fit_config_fn is not None:
             # Custom fit config function provided
             config = self.on_fit_config_fn(rnd)
+
+        if self.defense is not None or self.prefilter is not None:
+            self.global_weights = fl.common.parameters_to_weights(parameters)
+
+        if self.sparsity_ratio is not None:
+            self.round_weights[rnd] = fl.common.parameters_to_weights(parameters)
+            config["sparsity_ratio"] = self.sparsity_ratio
+
+        if self.codec is not None:
+            weights = fl.common.parameters_to_weights(parameters)
+            encoded = encode_weights(weights, self.codec)
+            parameters = fl.common.weights_to_parameters(encoded)
+            config["codec"] = self.codec
+
+            metrics_store.append(
+                rnd,
+                "server",
+                {
+                    "download_bytes_encoded": weights_nbytes(encoded),
+                    "download_bytes_decoded": weights_nbytes(weights),
+                },
+            )
+
         fit_ins = fl.common.FitIns(parameters, config)
 
         # Sample clients
@@ -146,8 +621,12 @@ class SaveModelStrategy(fl.server.strategy.FedAvg):
             client_manager.num_available()
         )
 
-        poisoned_clients_criterion = SelectClientsCritertion(poisoned=True)
-        non_poisoned_clients_criterion = SelectClientsCritertion(poisoned=False)
+        poisoned_clients_criterion = SelectClientsCritertion(
+            poisoned=True, client_manager=client_manager
+        )
+        non_poisoned_clients_criterion = SelectClientsCritertion(
+            poisoned=False, client_manager=client_manager
+        )
 
         selected_clients = []
 
@@ -177,6 +656,14 @@ class SaveModelStrategy(fl.server.strategy.FedAvg):
                 )
             )
 
+        if self.round_policy is not None:
+            selected_clients = [
+                client
+                for client in selected_clients
+                if client.cid not in self.dispatched
+            ]
+            self.dispatched |= {client.cid: rnd for client in selected_clients}
+
         # Return client/config pairs
         return [(client, fit_ins) for client in selected_clients]
 
@@ -190,14 +677,24 @@ class FLServer(fl.server.server.Server):
         fraction_fit: float,
         rounds: int,
         epochs: int,
+        validation: Optional[dict[str, Any]] = None,
+        codec: Optional[str] = None,
+        sparsity_ratio: Optional[float] = None,
+        streaming_aggregation: bool = False,
+        round_policy: Optional[dict[str, Any]] = None,
+        defense: Optional[dict[str, Any]] = None,
+        prefilter: Optional[dict[str, Any]] = None,
+        checkpoint: Optional[dict[str, Any]] = None,
+        resume: Optional[str] = None,
+        evaluation: Optional[dict[str, Any]] = None,
     ):
         self.poisoned_client_selection = poisoned_client_selection
         self.rounds = rounds
         self.epochs = epochs
         self.data_path = data_path
-        self.val_ds = get_test_val_ds(data_path)[1]
+        self.val_ds = get_dataset(data_path, SPLITS["valid"])
         model = create_model()
-        model.summary()
+        self.model = model
 
         self.strategy = SaveModelStrategy(
             initial_parameters=fl.common.weights_to_parameters(model.get_weights()),
@@ -207,19 +704,75 @@ class FLServer(fl.server.server.Server):
             fraction_fit=fraction_fit,
             min_eval_clients=0,
             fraction_eval=0.0,
-            eval_fn=FLServer.get_eval_fn(model, self.val_ds),
+            eval_fn=FLServer.get_eval_fn(model, self.val_ds, data_path, evaluation),
             on_fit_config_fn=self.on_fit_config,
             # custom arguments
             data_path=self.data_path,
             num_fl_clients=num_fl_clients,
             poisoned_client_selection=poisoned_client_selection,
+            validation=validation,
+            codec=codec,
+            sparsity_ratio=sparsity_ratio,
+            streaming=streaming_aggregation,
+            round_policy=round_policy,
+            defense=defense,
+            prefilter=prefilter,
         )
 
         super().__init__(
-            client_manager=fl.server.client_manager.SimpleClientManager(),
+            client_manager=PropertiesClientManager(),
             strategy=self.strategy,
         )
 
+        self.round_policy = round_policy
+        # Fits in flight, which can outlive the round they were started in,
+        # mapped to their client and round.
+        self.pending_fits: dict[
+            concurrent.futures.Future, tuple[fl.server.client_proxy.ClientProxy, int]
+        ] = {}
+        self.fit_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        if round_policy is not None:
+            self.fit_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers
+            )
+
+        self.checkpointer: Optional[Checkpointer] = None
+        if checkpoint is not None:
+            self.checkpointer = Checkpointer(**checkpoint, on_written=log_checkpoint)
+        # Rounds completed by the run that is resumed.
+        self.round_offset = 0
+        if resume is not None:
+            self.resume(resume)
+
+        # Seconds spent per startup phase, completed by the runner and by `fit`.
+        self.startup_seconds: dict[str, float] = {}
+        self.created = time.perf_counter()
+        # Collects the environment info once the server is up.
+        self.environment_thread: Optional[threading.Thread] = None
+
+    def fit(
+        self, num_rounds: int, timeout: Optional[float]
+    ) -> fl.server.history.History:
+        # Flower calls this once the gRPC server listens.
+        self.startup_seconds["listen"] = time.perf_counter() - self.created
+
+        self.environment_thread = threading.Thread(
+            target=self.log_environment, daemon=True
+        )
+        self.environment_thread.start()
+
+        return super().fit(num_rounds, timeout)
+
+    def log_environment(self) -> None:
+        """Log the installed packages, the server's platform and the model.
+
+        This is slow, mostly in pip, and nothing needs it to start a round.
+        """
+        start = time.perf_counter()
+
+        import cpuinfo  # type: ignore  # missing stub
+        from pip._internal.operations import freeze as pip_freeze
+
         l.log(
             {
                 "pip_info": {
@@ -241,6 +794,59 @@ class FLServer(fl.server.server.Server):
             }
         )
 
+        self.model.summary()
+
+        self.startup_seconds["environment"] = time.perf_counter() - start
+        l.log({"startup_seconds": self.startup_seconds})
+
+    def resume(self, path: str) -> None:
+        """Continue from the state saved in the checkpoint at `path`."""
+        state = load_state(path)
+
+        self.round_offset = state["round"]
+        self.strategy.resume_parameters = fl.common.weights_to_parameters(
+            state["global_weights"]
+        )
+        self.strategy.blacklist = state["blacklist"]
+        if self.strategy.validator is not None:
+            self.strategy.validator.restore(
+                state["reference_weights"], state["model_versions"]
+            )
+
+        l.log(
+            {
+                "resumed_from": {
+                    "checkpoint": path,
+                    "round": state["round"],
+                    "metrics_store": state["metadata"]["metrics_store"],
+                }
+            }
+        )
+
+    def save_checkpoint(
+        self, rnd: int, parameters: Optional[fl.common.Parameters]
+    ) -> None:
+        checkpointer = self.checkpointer
+        if checkpointer is None:
+            return
+
+        # Without an aggregate the global weights stay as they were.
+        if parameters is None:
+            parameters = self.parameters
+
+        validator = self.strategy.validator
+        checkpointer.save(
+            rnd,
+            pack_state(
+                rnd,
+                fl.common.parameters_to_weights(parameters),
+                validator.reference_weights if validator else [],
+                validator.model_versions if validator else [],
+                self.strategy.blacklist,
+                {"metrics_store": metrics_store.directory, "log": l._json_file_name},
+            ),
+        )
+
     def on_fit_config(self, rnd: int) -> dict[str, int]:
         return {
             "rnd": rnd,
@@ -248,35 +854,214 @@ class FLServer(fl.server.server.Server):
             "rounds": self.rounds,
         }
 
+    def fit_round(self, rnd: int, timeout: Optional[float]) -> Optional[tuple]:
+        """Run a round, either synchronously or under the round policy.
+
+        Under a policy the round ends once a quorum of its clients replied or
+        its deadline passed. Fits still running then are late. In "deadline"
+        mode their results are dropped when they arrive, in "async" mode they
+        are aggregated in the round they arrive in, weighted by staleness.
+        """
+        # Flower counts rounds from 1, also after a resume.
+        rnd += self.round_offset
+
+        with span("fit_round", round=rnd):
+            # Selection asks the client manager for client properties.
+            with span("configure_fit"):
+                client_instructions = self.strategy.configure_fit(
+                    rnd=rnd,
+                    parameters=self.parameters,
+                    client_manager=self._client_manager,
+                )
+
+            fits: Optional[
+                tuple[
+                    list[tuple[fl.server.client_proxy.ClientProxy, fl.common.FitRes]],
+                    list[BaseException],
+                ]
+            ] = None
+            if self.round_policy is not None:
+                with span("wait_for_fits", clients=len(client_instructions)):
+                    fits = self.collect_fits(rnd, client_instructions, timeout)
+            elif client_instructions:
+                with span("fit_clients", clients=len(client_instructions)):
+                    fits = fl.server.server.fit_clients(
+                        client_instructions=client_instructions,
+                        max_workers=self.max_workers,
+                        timeout=timeout,
+                    )
+
+            if fits is None:
+                return None
+            results, failures = fits
+
+            with span("aggregate_fit", results=len(results)):
+                parameters_aggregated, metrics_aggregated = self.strategy.aggregate_fit(
+                    rnd, results, failures
+                )
+
+            if self.checkpointer is not None and self.checkpointer.due(rnd):
+                with span("checkpoint"):
+                    self.save_checkpoint(rnd, parameters_aggregated)
+
+        return parameters_aggregated, metrics_aggregated, (results, failures)
+
+    def collect_fits(
+        self,
+        rnd: int,
+        client_instructions: list[
+            tuple[fl.server.client_proxy.ClientProxy, fl.common.FitIns]
+        ],
+        timeout: Optional[float],
+    ) -> Optional[
+        tuple[
+            list[tuple[fl.server.client_proxy.ClientProxy, fl.common.FitRes]],
+            list[BaseException],
+        ]
+    ]:
+        """Start the round's fits and return the results available once the
+        round policy's quorum or deadline is reached."""
+        round_policy = self.round_policy
+        fit_executor = self.fit_executor
+        if round_policy is None or fit_executor is None:
+            raise ValueError("collecting fits needs a round policy")
+
+        round_start = time.monotonic()
+
+        round_fits = set()
+        for client_proxy, ins in client_instructions:
+            future = fit_executor.submit(
+                fl.server.server.fit_client, client_proxy, ins, timeout
+            )
+            self.pending_fits[future] = (client_proxy, rnd)
+            round_fits.add(future)
+
+        if not self.pending_fits:
+            return None
+
+        quorum = round_policy.get("quorum", 1.0)
+        if isinstance(quorum, float):
+            quorum = math.ceil(quorum * len(round_fits))
+        # More replies than fits started this round would never come.
+        quorum = min(quorum, len(round_fits))
+
+        if not round_fits:
+            # Every client is still busy: wait for the first one to be back.
+            round_fits = set(self.pending_fits)
+            quorum = 1
+        seconds = round_policy.get("seconds")
+
+        done = {future for future in round_fits if future.done()}
+        while len(done) < quorum and round_fits - done:
+            remaining = None
+            if seconds is not None:
+                remaining = round_start + seconds - time.monotonic()
+                if remaining <= 0:
+                    break
+
+            newly_done, _ = concurrent.futures.wait(
+                round_fits - done,
+                timeout=remaining,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            done |= newly_done
+
+        results = []
+        failures = []
+        dropped = []
+        stale_updates = 0
+        for future in [future for future in self.pending_fits if future.done()]:
+            client_proxy, fit_round = self.pending_fits.pop(future)
+
+            exception = future.exception()
+            if exception is not None:
+                self.strategy.dispatched.pop(client_proxy.cid, None)
+                failures.append(exception)
+            elif fit_round < rnd and round_policy.get("mode") != "async":
+                self.strategy.dispatched.pop(client_proxy.cid, None)
+                dropped.append(client_proxy.cid)
+            else:
+                results.append(future.result())
+                stale_updates += fit_round < rnd
+
+        late = [
+            client_proxy.cid
+            for future, (client_proxy, fit_round) in self.pending_fits.items()
+            if fit_round == rnd
+        ]
+
+        for cid in late:
+            metrics_store.append(rnd, "client://" + str(cid), {"late": 1})
+        for cid in dropped:
+            metrics_store.append(rnd, "client://" + str(cid), {"dropped": 1})
+        metrics_store.append(
+            rnd,
+            "server",
+            {
+                "late_clients": len(late),
+                "dropped_clients": len(dropped),
+                "stale_updates": stale_updates,
+                "round_wait_seconds": time.monotonic() - round_start,
+            },
+        )
+
+        return results, failures
+
     def start(self) -> None:
         fl.server.start_server(
-            server=self, config={"num_rounds": self.rounds}, strategy=self.strategy
+            server=self,
+            config={"num_rounds": self.rounds - self.round_offset},
+            strategy=self.strategy,
         )
 
     @staticmethod
-    def get_eval_fn(model: tf.keras.models.Model, val_ds: tf.data.Dataset) -> Callable:
+    def get_eval_fn(
+        model: tf.keras.models.Model,
+        val_ds: tf.data.Dataset,
+        data_path: str,
+        evaluation: Optional[dict[str, Any]] = None,
+    ) -> Callable:
         """Return an evaluation function for server-side evaluation.
 
-        The returned function will be called on every round by the server.
+        The returned function will be called on every round by the server. It
+        predicts the validation set, memory-mapped in batches of `batch_size`
+        if it was converted and over the dataset pipeline otherwise, and
+        computes the requested `metrics` from the predictions, all of
+        `evaluator.METRICS` by default. With `batch_size: null` it runs
+        `model.evaluate` over the dataset pipeline instead.
         """
+        evaluation = {"batch_size": 1024, **(evaluation or {})}
+        names = ["loss", "accuracy"] + [
+            name
+            for name in evaluation.get("metrics", METRICS)
+            if name not in ("loss", "accuracy")
+        ]
+        unknown = set(names) - set(METRICS)
+        if unknown:
+            raise ValueError(f"unknown evaluation metrics {sorted(unknown)}")
 
         def evaluate(weights: fl.common.Weights) -> tuple[float, dict[str, Any]]:
-            model.set_weights(weights)  # Update model with the latest parameters
-            metrics = model.evaluate(val_ds)
+            with span("eval_fn"):
+                model.set_weights(weights)  # Update model with the latest parameters
 
-            accuracy = metrics[model.metrics_names.index("accuracy")]
-            loss = metrics[model.metrics_names.index("loss")]
+                if evaluation["batch_size"] is None:
+                    metrics = model.evaluate(val_ds)
+                    round_metrics = {
+                        model.metrics_names[k]: metrics[k] for k in range(len(metrics))
+                    }
+                else:
+                    if has_npy_split(data_path, "valid"):
+                        images, labels = get_arrays(data_path, "valid")
+                        probabilities = predict(model, images, evaluation["batch_size"])
+                    else:
+                        probabilities, labels = predict_batches(model, val_ds)
+                    round_metrics = compute_metrics(probabilities, labels, names)
+                    round_metrics["loss"] += sum(float(loss) for loss in model.losses)
 
-            round_metrics = {
-                model.metrics_names[k]: metrics[k] for k in range(len(metrics))
-            }
+            metrics_store.append(metrics_store.last_round, "server", round_metrics)
+            metrics_store.flush()
 
-            if len(all_metrics) == 0:
-                all_metrics[0] = {"server": round_metrics}
-            else:
-                all_metrics[len(all_metrics) - 1] |= {"server": round_metrics}
-
-            return loss, {"accuracy": accuracy}
+            return round_metrics["loss"], {"accuracy": round_metrics["accuracy"]}
 
         return evaluate
 
@@ -292,17 +1077,38 @@ class FLServer(fl.server.server.Server):
         return {"val_steps": val_steps}
 
     def disconnect_all_clients(self, timeout: Optional[float]) -> None:
+        # A client can only be disconnected once its last fit returned.
+        if self.fit_executor is not None:
+            self.fit_executor.shutdown(wait=True)
+            self.fit_executor = None
+
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+
+        # The log is not written from two threads at once.
+        if self.environment_thread is not None:
+            self.environment_thread.join()
+
         l.log(
             {
                 "client_system_info": {
                     "client_info": {
-                        cid: client.get_properties(get_properties_ins, None).properties
+                        cid: self.client_manager().get_client_properties(client)
                         for cid, client in self.client_manager().clients.items()
                     }
                 }
             }
         )
 
-        l.log({"all_metrics": all_metrics})
+        metrics_store.flush()
+        l.log({"metrics_store": metrics_store.directory})
+
+        if tracer.enabled:
+            trace_file = os.path.splitext(l._json_file_name)[0] + ".trace.json"
+            tracer.export(trace_file)
+            l.log({"trace": trace_file})
+
+        if self.strategy.validator is not None:
+            self.strategy.validator.close()
 
         super().disconnect_all_clients(timeout)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+import flwr as fl  # type: ignore
+
+from client import FLClient
+from model import ModelPool
+
+if TYPE_CHECKING:
+    from typing import Any, Optional
+
+    from server import FLServer
+
+EXECUTORS = ("thread", "process")
+
+# Clients hosted by a shard process, filled by `_call_in_shard`.
+_shard: dict[str, Any] = {}
+
+
+def _init_shard() -> None:
+    _shard["model_pool"] = ModelPool(1)
+    _shard["clients"] = {}
+
+
+def _call_in_shard(
+    cid: str, client_kwargs: dict[str, Any], method: str, *args: Any
+) -> Any:
+    clients = _shard["clients"]
+    if cid not in clients:
+        clients[cid] = fl.client.numpy_client.NumPyClientWrapper(
+            FLClient(**client_kwargs, model_pool=_shard["model_pool"])
+        )
+
+    return getattr(clients[cid], method)(*args)
+
+
+class InProcessClientProxy(fl.server.client_proxy.ClientProxy):
+    """Client proxy that calls an `FLClient` directly instead of over gRPC.
+
+    The client lives in this process, borrowing models from `model_pool`, or,
+    if a `shard` is given, in that shard's worker process.
+    """
+
+    def __init__(
+        self,
+        cid: str,
+        client_kwargs: dict[str, Any],
+        model_pool: Optional[ModelPool] = None,
+        shard: Optional[ProcessPoolExecutor] = None,
+    ):
+        super().__init__(cid)
+        self.client_kwargs = client_kwargs
+        self.shard = shard
+
+        self.client: Optional[fl.client.Client] = None
+        if shard is None:
+            self.client = fl.client.numpy_client.NumPyClientWrapper(
+                FLClient(**client_kwargs, model_pool=model_pool)
+            )
+
+    def _call(self, method: str, *args: Any) -> Any:
+        if self.shard is None:
+            return getattr(self.client, method)(*args)
+
+        return self.shard.submit(
+            _call_in_shard, self.cid, self.client_kwargs, method, *args
+        ).result()
+
+    def get_properties(
+        self, ins: fl.common.PropertiesIns, timeout: Optional[float]
+    ) -> fl.common.PropertiesRes:
+        return self._call("get_properties", ins)
+
+    def get_parameters(self, timeout: Optional[float]) -> fl.common.ParametersRes:
+        return self._call("get_parameters")
+
+    def fit(self, ins: fl.common.FitIns, timeout: Optional[float]) -> fl.common.FitRes:
+        return self._call("fit", ins)
+
+    def evaluate(
+        self, ins: fl.common.EvaluateIns, timeout: Optional[float]
+    ) -> fl.common.EvaluateRes:
+        return self._call("evaluate", ins)
+
+    def reconnect(
+        self, reconnect: fl.common.Reconnect, timeout: Optional[float]
+    ) -> fl.common.Disconnect:
+        return fl.common.Disconnect(reason="")
+
+
+def simulate(
+    server: FLServer,
+    client_kwargs: list[dict[str, Any]],
+    executor: str = "thread",
+    workers: int = multiprocessing.cpu_count(),
+) -> fl.server.history.History:
+    """Run all rounds of `server` against in-process clients, one per entry of
+    `client_kwargs`.
+
+    With the "thread" executor all clients share this process, its datasets
+    and a pool of `workers` models, so at most `workers` clients train at once.
+    With the "process" executor clients are sharded over `workers` spawned
+    processes, each training one client at a time.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f"unknown simulation executor {executor}")
+
+    shards: list[ProcessPoolExecutor] = []
+    if executor == "thread":
+        model_pool = ModelPool(workers)
+        clients = [
+            InProcessClientProxy(str(index), kwargs, model_pool=model_pool)
+            for index, kwargs in enumerate(client_kwargs)
+        ]
+        server.set_max_workers(workers)
+    else:
+        # TensorFlow is not fork-safe, so shards are spawned.
+        shards = [
+            ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_shard,
+            )
+            for _ in range(workers)
+        ]
+        clients = [
+            InProcessClientProxy(str(index), kwargs, shard=shards[index % workers])
+            for index, kwargs in enumerate(client_kwargs)
+        ]
+        server.set_max_workers(len(clients))
+
+    for client in clients:
+        server.client_manager().register(client)
+
+    try:
+        history = server.fit(
+            num_rounds=server.rounds - server.round_offset, timeout=None
+        )
+        server.disconnect_all_clients(timeout=None)
+    finally:
+        for shard in shards:
+            shard.shutdown()
+
+    return history
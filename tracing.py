@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Optional
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer: Tracer, name: str, args: dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self) -> _Span:
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.tracer._record(self.name, self.start, time.perf_counter_ns(), self.args)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> _NullSpan:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Tracer:
+    """Collector of nested timing spans, exported as a Chrome trace.
+
+    Spans are recorded as complete events per thread, so the trace viewer
+    nests them by time. While disabled, `span` returns a shared no-op context
+    manager.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.events: list[dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def span(self, name: str, **args: Any) -> Any:
+        if not self.enabled:
+            return _null_span
+
+        return _Span(self, name, args)
+
+    def _record(
+        self, name: str, start: int, end: int, args: Optional[dict[str, Any]]
+    ) -> None:
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self._origin) / 1000,
+            "dur": (end - start) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+
+        with self._lock:
+            self.events.append(event)
+
+    def export(self, path: str) -> None:
+        """Write the spans recorded so far as a Chrome trace / Perfetto JSON
+        file."""
+        with self._lock:
+            events = list(self.events)
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# Process-wide tracer, enabled by the runner.
+tracer = Tracer()
+span = tracer.span
@@ -2,31 +2,215 @@
 
 from __future__ import annotations
 
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from typing import TYPE_CHECKING
 
 import flwr as fl  # type: ignore
+import numpy as np
 
-from cinic10_ds import get_test_val_ds
-from model import create_model
+from cinic10_ds import SPLITS, get_arrays, get_dataset, has_npy_split
+from codec import fit_res_to_weights
+from evaluator import ArrayBatches, CandidateEvaluator
+from model import ModelPool
+from tracing import span
 
 if TYPE_CHECKING:
-    from typing import Union
+    from typing import Any, Iterable, Optional, Union
+
+    import tensorflow as tf  # type: ignore
+
+
+# State of a validation worker process, filled by `_init_worker`.
+_worker: dict[str, Any] = {}
+
+
+def _init_worker(
+    data_path: str,
+    intra_op_threads: int,
+    batch_size: Optional[int],
+    num_of_models: int,
+) -> None:
+    import tensorflow as tf  # type: ignore
+
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    # Build the models of a job now rather than in the first round.
+    _worker["evaluator"] = CandidateEvaluator()
+    _worker["evaluator"].prepare(num_of_models)
+    # Without a converted split, every worker would hold a copy of its own.
+    _worker["val_ds"] = (
+        ArrayBatches(*get_arrays(data_path, "valid"), batch_size)
+        if batch_size is not None and has_npy_split(data_path, "valid")
+        else get_dataset(data_path, SPLITS["valid"])
+    )
+
+
+def _evaluate_in_worker(
+    client_weights: Optional[fl.common.Weights],
+    reference_weights: list[fl.common.Weights],
+) -> tuple[list[dict[str, Union[float, int]]], int]:
+    """Evaluate the mix of a client with every reference, or the references
+    themselves if no client weights are given. Also returns the number of
+    samples evaluated per candidate."""
+    if client_weights is None:
+        candidates = reference_weights
+    else:
+        candidates = [
+            fl.server.strategy.aggregate.aggregate([(client_weights, 1), (weights, 1)])
+            for weights in reference_weights
+        ]
+
+    metrics = _worker["evaluator"].evaluate(candidates, _worker["val_ds"])
+    return metrics, _worker["evaluator"].last_sample_count
 
 
 class ValidationServer:
-    def __init__(self, num_of_models: int = 3, data_path: str = "data/"):
+    """Vote on client updates by mixing them with recent global models.
+
+    In the default "exhaustive" mode every client is compared against every
+    reference model on the full validation set. The "sequential" mode
+    evaluates growing stratified chunks of the validation set, settles each
+    comparison as soon as a confidence bound allows it and stops asking further
+    references once the majority vote is decided. The "pool" mode runs the
+    exhaustive comparisons in long-lived worker processes, one client per job.
+
+    Evaluation runs over the validation set held in memory, in batches of
+    `batch_size`, or over its dataset pipeline if `batch_size` is None.
+    """
+
+    def __init__(
+        self,
+        num_of_models: int = 3,
+        data_path: str = "data/",
+        mode: str = "exhaustive",
+        confidence_z: float = 3.0,
+        initial_chunk: int = 1024,
+        chunk_growth: float = 2.0,
+        seed: int = 42,
+        workers: int = multiprocessing.cpu_count(),
+        intra_op_threads: int = 1,
+        batch_size: Optional[int] = 1024,
+        model_pool: Optional[ModelPool] = None,
+    ):
+        if mode not in ("exhaustive", "sequential", "pool"):
+            raise ValueError(f"unknown validation mode {mode}")
+
+        self.mode = mode
+        self.confidence_z = confidence_z
+        self.initial_chunk = initial_chunk
+        self.chunk_growth = chunk_growth
+        self.seed = seed
+
+        self.data_path = data_path
         self.num_of_models = num_of_models
         if self.num_of_models % 2 == 0:
             self.num_of_models += 1
 
-        self.models = []
-        for _ in range(self.num_of_models):
-            self.models.append(create_model())
+        # The references are only ever evaluated through `self.evaluator`, so
+        # they are kept as weights, initially those of fresh models.
+        model_pool = model_pool or ModelPool(1)
+        self.reference_weights = [
+            model_pool.initial_weights() for _ in range(self.num_of_models)
+        ]
+
+        # Reference models only change when `update` replaces them, so their
+        # metrics are cached per slot together with the weight version they
+        # were computed for.
+        self.model_versions = [0] * self.num_of_models
+        self.reference_metrics: dict[int, tuple[int, dict[str, Union[float, int]]]] = {}
+
+        self.evaluator = CandidateEvaluator()
 
-        _, self.val_ds = get_test_val_ds(data_path)
+        # Per-client number of validation samples and reference comparisons
+        # that went into the latest decisions.
+        self.decision_stats: dict[str, dict[str, int]] = {}
+
+        self.batch_size = batch_size
+        self.val_ds = get_dataset(data_path, SPLITS["valid"])
+        self._val_batches: Optional[ArrayBatches] = None
+
+        # Sequential mode works on in-memory arrays of the validation set and
+        # on per-sample correctness of the references, both built lazily.
+        self._val_arrays: Optional[tuple[np.ndarray, np.ndarray]] = None
+        self._val_order: Optional[np.ndarray] = None
+        self._val_bounds: list[int] = []
+        self.reference_correctness: dict[int, tuple[int, np.ndarray]] = {}
+
+        self.pool: Optional[ProcessPoolExecutor] = None
+        if self.mode == "pool":
+            # TensorFlow is not fork-safe, so workers are spawned and build their
+            # own model instances and validation dataset.
+            self.pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(data_path, intra_op_threads, batch_size, self.num_of_models),
+            )
 
     def update(self, model_weights: fl.common.Weights, cur_round: int) -> None:
-        self.models[cur_round % self.num_of_models].set_weights(model_weights)
+        slot = cur_round % self.num_of_models
+
+        self.reference_weights[slot] = model_weights
+        self.model_versions[slot] += 1
+        self.reference_metrics.pop(slot, None)
+        self.reference_correctness.pop(slot, None)
+
+    def restore(
+        self, reference_weights: list[fl.common.Weights], model_versions: list[int]
+    ) -> None:
+        """Load the reference models of an earlier run, e.g. from a checkpoint."""
+        if len(reference_weights) != self.num_of_models:
+            raise ValueError(
+                f"expected {self.num_of_models} reference models, "
+                f"got {len(reference_weights)}"
+            )
+
+        self.reference_weights = list(reference_weights)
+        self.model_versions = list(model_versions)
+        self.reference_metrics = {}
+        self.reference_correctness = {}
+
+    @property
+    def val_data(self) -> Union[tf.data.Dataset, ArrayBatches]:
+        if self.batch_size is None or not has_npy_split(self.data_path, "valid"):
+            return self.val_ds
+
+        if self._val_batches is None:
+            self._val_batches = ArrayBatches(
+                *get_arrays(self.data_path, "valid"), self.batch_size
+            )
+
+        return self._val_batches
+
+    def refresh_reference_metrics(
+        self,
+        slots: list[int],
+        candidates: Optional[list[fl.common.Weights]] = None,
+    ) -> list[dict[str, Union[float, int]]]:
+        """Re-evaluate the stale reference models among `slots`.
+
+        The stale references share their pass over the validation data with
+        `candidates`, whose metrics are returned.
+        """
+        candidates = candidates or []
+        stale_slots = [
+            slot
+            for slot in slots
+            if self.reference_metrics.get(slot, (None,))[0] != self.model_versions[slot]
+        ]
+
+        metrics = self.evaluator.evaluate(
+            [self.reference_weights[slot] for slot in stale_slots] + candidates,
+            self.val_data,
+        )
+
+        for slot, slot_metrics in zip(stale_slots, metrics):
+            self.reference_metrics[slot] = (self.model_versions[slot], slot_metrics)
+
+        return metrics[len(stale_slots) :]
 
     @staticmethod
     def compare_model_performance(
@@ -38,45 +222,316 @@ class ValidationServer:
         self,
         results: list[tuple[fl.server.client_proxy.ClientProxy, fl.common.FitRes]],
     ) -> dict[str, bool]:
+        self.decision_stats = {}
+
+        return self.validate_updates(
+            (client_proxy.cid, fit_res_to_weights(fit_res))
+            for client_proxy, fit_res in results
+        )
+
+    def validate_client(self, cid: str, weights: fl.common.Weights) -> bool:
+        """Validate a single client update; its decision stats are added to
+        those of the other clients validated since the last `validate_clients`."""
+        return self.validate_updates([(cid, weights)])[cid]
+
+    def validate_updates(
+        self, updates: Iterable[tuple[str, fl.common.Weights]]
+    ) -> dict[str, bool]:
+        if self.mode == "sequential":
+            return self.validate_updates_sequential(updates)
+        if self.mode == "pool":
+            return self.validate_updates_pool(updates)
+
         votes: dict[str, list[bool]] = {}
 
-        model_to_validate = create_model()
+        reference_weights = self.reference_weights
 
-        reference_model_metrics = []
-        for reference_model in self.models:
-            reference_model_metrics.append(
-                {
-                    reference_model.metrics_names[index]: metric
-                    for index, metric in enumerate(
-                        reference_model.evaluate(self.val_ds)
+        cids = []
+        candidates = []
+        for cid, client_model_weights in updates:
+            cids.append(cid)
+
+            with span("mix_client", cid=cid):
+                for weights in reference_weights:
+                    candidates.append(
+                        fl.server.strategy.aggregate.aggregate(
+                            [(client_model_weights, 1), (weights, 1)]
+                        )
                     )
+
+        # All candidates and stale references are scored in one data pass.
+        with span("evaluate_candidates", candidates=len(candidates)):
+            candidate_metrics = self.refresh_reference_metrics(
+                list(range(self.num_of_models)), candidates
+            )
+
+        for client_index, cid in enumerate(cids):
+            votes[cid] = [
+                self.compare_model_performance(
+                    self.reference_metrics[index][1],
+                    candidate_metrics[client_index * self.num_of_models + index],
+                )
+                for index in range(self.num_of_models)
+            ]
+
+        self.decision_stats.update(
+            {
+                cid: {
+                    "samples": self.evaluator.last_sample_count * self.num_of_models,
+                    "references": self.num_of_models,
                 }
+                for cid in votes
+            }
+        )
+
+        return {
+            cid: sum(comparison_results) > self.num_of_models / 2
+            for cid, comparison_results in votes.items()
+        }
+
+    def _prepare_sequential(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Materialize the validation set and a stratified sample order whose
+        every prefix has roughly the class balance of the full set, once.
+        Returns the images, labels and order."""
+        if self._val_arrays is not None and self._val_order is not None:
+            return (*self._val_arrays, self._val_order)
+
+        images, labels = get_arrays(self.data_path, "valid")
+        self._val_arrays = (images, labels)
+
+        rng = np.random.default_rng(self.seed)
+        keys = np.empty(len(labels), dtype=np.float64)
+        for label in np.unique(labels):
+            indices = np.flatnonzero(labels == label)
+            keys[rng.permutation(indices)] = (np.arange(len(indices)) + 0.5) / len(
+                indices
             )
+        order = np.argsort(keys, kind="stable")
+        self._val_order = order
+
+        self._val_bounds = []
+        bound = self.initial_chunk
+        while bound < len(labels):
+            self._val_bounds.append(bound)
+            bound = int(math.ceil(bound * self.chunk_growth))
+        self._val_bounds.append(len(labels))
+
+        return images, labels, order
+
+    def get_reference_correctness(self) -> list[np.ndarray]:
+        """Return the per-sample correctness of every reference model, evaluating
+        only references whose weights changed."""
+        images, labels, _ = self._prepare_sequential()
+        stale_slots = [
+            slot
+            for slot in range(self.num_of_models)
+            if self.reference_correctness.get(slot, (None,))[0]
+            != self.model_versions[slot]
+        ]
+
+        correct = self.evaluator.correctness(
+            [self.reference_weights[slot] for slot in stale_slots],
+            images,
+            labels,
+            self.batch_size or 256,
+        )
+        for slot, slot_correct in zip(stale_slots, correct):
+            self.reference_correctness[slot] = (self.model_versions[slot], slot_correct)
+
+        return [
+            self.reference_correctness[slot][1] for slot in range(self.num_of_models)
+        ]
+
+    def _settle(
+        self, differences: list, num_samples: int, total: int
+    ) -> Optional[bool]:
+        """Decide whether the candidate beats the reference on the full set, or
+        return None if the samples seen so far cannot tell yet.
+
+        `differences` holds the sum and the sum of squares of the per-sample
+        correctness differences (candidate minus reference).
+        """
+        mean = differences[0] / num_samples
+        if num_samples >= total:
+            return mean > 0
+
+        variance = max(differences[1] / num_samples - mean**2, 0.0)
+        # Samples are drawn without replacement from the validation set, so the
+        # bound shrinks to zero once the whole set has been seen.
+        bound = self.confidence_z * math.sqrt(
+            variance / num_samples * (total - num_samples) / (total - 1)
+        )
+
+        if abs(mean) > bound:
+            return mean > 0
+
+        return None
+
+    def validate_updates_sequential(
+        self, updates: Iterable[tuple[str, fl.common.Weights]]
+    ) -> dict[str, bool]:
+        images, labels, order = self._prepare_sequential()
+        total = len(labels)
+        majority = self.num_of_models // 2 + 1
+
+        reference_weights = self.reference_weights
+        reference_correct = self.get_reference_correctness()
+
+        clients = [
+            {
+                "cid": cid,
+                "weights": weights,
+                "votes": [],
+                # slot -> [next chunk, sum of differences, sum of squares]
+                "active": {},
+                "next_slot": 0,
+                "samples": 0,
+            }
+            for cid, weights in updates
+        ]
+        decisions: dict[str, bool] = {}
 
-        for client_proxy, fit_res in results:
-            votes[client_proxy.cid] = []
+        while True:
+            # Only ask as many references as are still needed to settle the vote.
+            for client in clients:
+                if client["cid"] in decisions:
+                    continue
 
-            client_model_weights = fl.common.parameters_to_weights(fit_res.parameters)
+                positive = sum(client["votes"])
+                negative = len(client["votes"]) - positive
+                needed = min(majority - positive, majority - negative)
+                while (
+                    len(client["active"]) < needed
+                    and client["next_slot"] < self.num_of_models
+                ):
+                    client["active"][client["next_slot"]] = [0, 0, 0]
+                    client["next_slot"] += 1
 
-            for index, reference_model in enumerate(self.models):
-                model_to_validate.set_weights(
-                    fl.server.strategy.aggregate.aggregate(
-                        [(client_model_weights, 1), (reference_model.get_weights(), 1)]
+            stages: dict[int, list[tuple[dict, int]]] = {}
+            for client in clients:
+                for slot, pair in client["active"].items():
+                    stages.setdefault(pair[0], []).append((client, slot))
+
+            if not stages:
+                break
+
+            for stage, pairs in stages.items():
+                start = self._val_bounds[stage - 1] if stage else 0
+                end = self._val_bounds[stage]
+                indices = order[start:end]
+
+                with span(
+                    "validation_stage",
+                    samples=end - start,
+                    clients=sorted({client["cid"] for client, _ in pairs}),
+                ):
+                    correct = self.evaluator.correctness(
+                        [
+                            fl.server.strategy.aggregate.aggregate(
+                                [(client["weights"], 1), (reference_weights[slot], 1)]
+                            )
+                            for client, slot in pairs
+                        ],
+                        images[indices],
+                        labels[indices],
+                        self.batch_size or 256,
                     )
-                )
 
-                model_to_validate_metrics = {
-                    model_to_validate.metrics_names[i]: metric
-                    for i, metric in enumerate(model_to_validate.evaluate(self.val_ds))
+                for (client, slot), pair_correct in zip(pairs, correct):
+                    difference = pair_correct.astype(np.int64) - reference_correct[
+                        slot
+                    ][indices].astype(np.int64)
+
+                    pair = client["active"][slot]
+                    pair[0] += 1
+                    pair[1] += int(difference.sum())
+                    pair[2] += int((difference**2).sum())
+                    client["samples"] += end - start
+
+                    vote = self._settle(pair[1:], end, total)
+                    if vote is not None:
+                        client["votes"].append(vote)
+                        del client["active"][slot]
+
+            for client in clients:
+                positive = sum(client["votes"])
+                negative = len(client["votes"]) - positive
+                if positive >= majority or negative >= majority:
+                    decisions[client["cid"]] = positive >= majority
+                    client["active"] = {}
+
+        self.decision_stats.update(
+            {
+                client["cid"]: {
+                    "samples": client["samples"],
+                    "references": client["next_slot"],
                 }
+                for client in clients
+            }
+        )
 
-                votes[client_proxy.cid].append(
-                    self.compare_model_performance(
-                        reference_model_metrics[index], model_to_validate_metrics
-                    )
+        return decisions
+
+    def validate_updates_pool(
+        self, updates: Iterable[tuple[str, fl.common.Weights]]
+    ) -> dict[str, bool]:
+        pool = self.pool
+        if pool is None:
+            raise ValueError("pool validation needs a worker pool")
+
+        reference_weights = self.reference_weights
+
+        stale_slots = [
+            slot
+            for slot in range(self.num_of_models)
+            if self.reference_metrics.get(slot, (None,))[0] != self.model_versions[slot]
+        ]
+        reference_future = None
+        if stale_slots:
+            reference_future = pool.submit(
+                _evaluate_in_worker,
+                None,
+                [reference_weights[slot] for slot in stale_slots],
+            )
+
+        client_futures = {
+            cid: pool.submit(_evaluate_in_worker, weights, reference_weights)
+            for cid, weights in updates
+        }
+
+        if reference_future is not None:
+            for slot, slot_metrics in zip(stale_slots, reference_future.result()[0]):
+                self.reference_metrics[slot] = (self.model_versions[slot], slot_metrics)
+
+        votes = {}
+        samples = {}
+        for cid, future in client_futures.items():
+            with span("wait_for_client", cid=cid):
+                client_metrics, samples[cid] = future.result()
+
+            votes[cid] = [
+                self.compare_model_performance(
+                    self.reference_metrics[index][1], candidate_metrics
                 )
+                for index, candidate_metrics in enumerate(client_metrics)
+            ]
+
+        self.decision_stats.update(
+            {
+                cid: {
+                    "samples": samples[cid] * self.num_of_models,
+                    "references": self.num_of_models,
+                }
+                for cid in votes
+            }
+        )
 
         return {
             cid: sum(comparison_results) > self.num_of_models / 2
             for cid, comparison_results in votes.items()
         }
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None